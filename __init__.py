@@ -4,20 +4,37 @@
 
 """
 from trytond.pool import Pool
-from sale_return import ReturnPolicy, ReturnPolicyTerm, ReturnReason
+from sale_return import ReturnPolicy, ReturnPolicyVersion, ReturnPolicyTerm, \
+    ReturnReason, ReturnPolicyTermRule, ReturnHistory, ReturnArchive
 from sale import SaleLine, SaleConfiguration, Sale
-from product import ProductCategory, ProductTemplate
+from product import ProductCategory, ProductTemplate, \
+    AssignReturnPolicyStart, AssignReturnPolicy
+from return_import import ReturnImport
+from return_audit import ReturnAudit
+from event import ReturnEvent
 
 
 def register():
     Pool.register(
         ReturnReason,
         ReturnPolicy,
+        ReturnPolicyVersion,
         ReturnPolicyTerm,
+        ReturnPolicyTermRule,
+        ReturnHistory,
+        ReturnArchive,
         ProductCategory,
         ProductTemplate,
         Sale,
         SaleConfiguration,
         SaleLine,
+        ReturnImport,
+        ReturnAudit,
+        ReturnEvent,
+        AssignReturnPolicyStart,
         module='sale_return', type_='model'
     )
+    Pool.register(
+        AssignReturnPolicy,
+        module='sale_return', type_='wizard'
+    )
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+    event.py
+
+"""
+import datetime
+import json
+import sqlite3
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import PoolMeta
+from trytond.transaction import Transaction
+from trytond.config import config
+from trytond.tools import reduce_ids
+from trytond import backend
+
+__all__ = ['ReturnEvent']
+__metaclass__ = PoolMeta
+
+# Delivery targets of the return events by URI scheme
+TARGETS = {}
+
+
+def register_target(scheme):
+    """
+    Register the decorated class as the delivery target of the URI scheme
+    """
+    def register(target):
+        TARGETS[scheme] = target
+        return target
+    return register
+
+
+@register_target('file')
+class FileTarget(object):
+    """
+    Append the events as JSON lines to a local file
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def deliver(self, events):
+        with open(self.path, 'a') as fileobj:
+            for event in events:
+                fileobj.write(json.dumps(event, sort_keys=True) + '\n')
+
+
+@register_target('sqlite')
+class SQLiteTarget(object):
+    """
+    Insert the events in the return_event table of a SQLite database
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def deliver(self, events):
+        connection = sqlite3.connect(self.path)
+        try:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS return_event '
+                '(id INTEGER PRIMARY KEY, type TEXT, payload TEXT)'
+            )
+            connection.executemany(
+                'INSERT OR IGNORE INTO return_event VALUES (?, ?, ?)', [
+                    (e['id'], e['type'], json.dumps(e, sort_keys=True))
+                    for e in events
+                ]
+            )
+            connection.commit()
+        finally:
+            connection.close()
+
+
+class ReturnEvent(ModelSQL, ModelView):
+    """
+    Sale Return Event
+
+    Outbox of the events of the return sales, written in the transaction
+    which confirms or cancels them and delivered in batches by a cron to the
+    target configured by the event_target option of the sale_return
+    section, like file:///var/spool/returns.jsonl or sqlite:///tmp/events.db
+    """
+    __name__ = 'sale.return.event'
+
+    sale = fields.Many2One(
+        'sale.sale', 'Sale', required=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    type = fields.Selection([
+        ('confirmed', 'Confirmed'),
+        ('cancelled', 'Cancelled'),
+    ], 'Type', required=True, readonly=True)
+    payload = fields.Text('Payload', required=True, readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+    ], 'State', required=True, readonly=True)
+    dispatch_date = fields.DateTime('Dispatch Date', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ReturnEvent, cls).__setup__()
+        cls._order.insert(0, ('id', 'DESC'))
+        cls._error_messages.update({
+            'invalid_target': 'Unknown return event target "%s".',
+        })
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(ReturnEvent, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['state', 'id'], 'add')
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @classmethod
+    def _get_payload(cls, type_, sale):
+        """
+        Returns the payload of the event of the return sale
+        """
+        return {
+            'type': type_,
+            'sale': sale.id,
+            'reference': sale.reference,
+            'company': sale.company.id,
+            'party': sale.party.id,
+            'sale_date': sale.sale_date and sale.sale_date.isoformat(),
+            'lines': [{
+                'id': l.id,
+                'origin': str(l.origin) if l.origin else None,
+                'product': l.product.id,
+                'quantity': l.quantity,
+                'return_type': l.return_type,
+                'return_reason': l.return_reason and l.return_reason.id,
+                'rma_channel': l.rma_channel,
+                'rma_reference': l.rma_reference,
+            } for l in sale.lines if l.is_return],
+        }
+
+    @classmethod
+    def add(cls, type_, sales):
+        """
+        Add the events of the return sales to the outbox
+        """
+        to_create = []
+        for sale in sales:
+            if not sale.has_return:
+                continue
+            to_create.append({
+                'sale': sale.id,
+                'type': type_,
+                'payload': json.dumps(cls._get_payload(type_, sale)),
+            })
+        if to_create:
+            cls.create(to_create)
+
+    @classmethod
+    def get_target(cls):
+        """
+        Returns the configured delivery target or None
+        """
+        uri = config.get('sale_return', 'event_target')
+        if not uri:
+            return None
+        scheme, _, path = uri.partition(':')
+        if scheme not in TARGETS:
+            cls.raise_user_error('invalid_target', (uri,))
+        if path.startswith('//'):
+            path = path[2:]
+        return TARGETS[scheme](path)
+
+    @classmethod
+    def dispatch(cls, target, batch_size=1000):
+        """
+        Deliver the pending events to the target by batches of batch_size
+        in the order they were created and mark them as done, in the
+        current transaction.
+
+        Returns the number of delivered events
+        """
+        delivered = 0
+        while True:
+            count = cls._dispatch_batch(target, batch_size)
+            if not count:
+                return delivered
+            delivered += count
+
+    @classmethod
+    def cron_dispatch(cls, batch_size=1000):
+        """
+        Deliver the pending events to the configured target, each batch in
+        a transaction of its own which is committed once delivered, so a
+        failure only retries the failed batch.
+
+        Returns the number of delivered events
+        """
+        target = cls.get_target()
+        if target is None:
+            return 0
+
+        delivered = 0
+        while True:
+            with Transaction().new_cursor():
+                count = cls._dispatch_batch(target, batch_size)
+                Transaction().cursor.commit()
+            if not count:
+                return delivered
+            delivered += count
+
+    @classmethod
+    def _dispatch_batch(cls, target, batch_size):
+        """
+        Deliver the next batch of pending events and mark them as done
+
+        Returns the number of delivered events
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        cursor.execute(*table.select(
+            table.id, table.payload,
+            where=table.state == 'pending',
+            order_by=table.id.asc,
+            limit=batch_size
+        ))
+        rows = cursor.fetchall()
+        if not rows:
+            return 0
+        events = []
+        for event_id, payload in rows:
+            event = json.loads(payload)
+            event['id'] = event_id
+            events.append(event)
+
+        target.deliver(events)
+
+        cursor.execute(*table.update(
+            columns=[table.state, table.dispatch_date],
+            values=['done', datetime.datetime.now()],
+            where=reduce_ids(table.id, [r[0] for r in rows])
+        ))
+        return len(rows)
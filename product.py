@@ -3,21 +3,84 @@
     product.py
 
 """
-from trytond.model import fields
-from trytond.pool import PoolMeta
+from sql.conditionals import Coalesce
+from sql.functions import Now
+
+from trytond.model import ModelView, fields
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
+from trytond.transaction import Transaction
+from trytond.cache import Cache
+from trytond.tools import reduce_ids
+
+from profiler import profiled
 
-__all__ = ['ProductCategory', 'ProductTemplate']
+__all__ = [
+    'ProductCategory', 'ProductTemplate', 'AssignReturnPolicyStart',
+    'AssignReturnPolicy',
+]
 __metaclass__ = PoolMeta
 
 
-class ProductCategory:
+class ReturnPolicyAssignMixin(object):
+
+    @classmethod
+    def assign_return_policy(cls, domain, policy):
+        """
+        Set the return policy on all the records matching the domain with
+        set-based updates by chunks, the policy is cleared if it is None.
+
+        Returns the number of updated records
+        """
+        ProductTemplate = Pool().get('product.template')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        ids = map(int, cls.search(domain, order=[]))
+        for i in range(0, len(ids), cursor.IN_MAX):
+            cursor.execute(*table.update(
+                columns=[
+                    table.return_policy, table.write_uid, table.write_date,
+                ],
+                values=[policy and int(policy), Transaction().user, Now()],
+                where=reduce_ids(table.id, ids[i:i + cursor.IN_MAX])
+            ))
+        ProductTemplate._effective_return_policy_cache.clear()
+        return len(ids)
+
+
+class ProductCategory(ReturnPolicyAssignMixin):
+    __metaclass__ = PoolMeta
     __name__ = 'product.category'
 
     return_policy = fields.Many2One('sale.return.policy', 'Return Policy')
 
+    @classmethod
+    def create(cls, vlist):
+        ProductTemplate = Pool().get('product.template')
+
+        categories = super(ProductCategory, cls).create(vlist)
+        ProductTemplate._effective_return_policy_cache.clear()
+        return categories
 
-class ProductTemplate:
+    @classmethod
+    def write(cls, *args):
+        ProductTemplate = Pool().get('product.template')
+
+        super(ProductCategory, cls).write(*args)
+        ProductTemplate._effective_return_policy_cache.clear()
+
+    @classmethod
+    def delete(cls, categories):
+        ProductTemplate = Pool().get('product.template')
+
+        super(ProductCategory, cls).delete(categories)
+        ProductTemplate._effective_return_policy_cache.clear()
+
+
+class ProductTemplate(ReturnPolicyAssignMixin):
+    __metaclass__ = PoolMeta
     __name__ = 'product.template'
 
     return_policy = fields.Many2One(
@@ -39,12 +102,115 @@ class ProductTemplate:
         'get_effective_return_policy'
     )
 
-    def get_effective_return_policy(self, name):
+    _effective_return_policy_cache = Cache(
+        'product.template.effective_return_policy'
+    )
+
+    @classmethod
+    def join_effective_return_policy(cls, query, template):
+        """
+        Returns the query left joined with the templates of the template
+        column and their categories, and the expression of their effective
+        return policy: the template's return policy if there else the
+        category's return policy
+        """
+        Category = Pool().get('product.category')
+        table = cls.__table__()
+        category = Category.__table__()
+
+        query = query.join(
+            table, 'LEFT', condition=template == table.id
+        ).join(
+            category, 'LEFT', condition=table.category == category.id
+        )
+        return query, Coalesce(table.return_policy, category.return_policy)
+
+    @classmethod
+    @profiled('product.template.get_effective_return_policy')
+    def get_effective_return_policy(cls, templates, name):
         """
         Returns the product's return policy if there else return the product
         category's return policy
         """
-        if self.return_policy:
-            return self.return_policy.id
-        elif self.category and self.category.return_policy:
-            return self.category.return_policy.id
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        result = {}
+        missing = []
+        for template in templates:
+            cached = cls._effective_return_policy_cache.get(template.id, -1)
+            if cached != -1:
+                result[template.id] = cached
+            else:
+                missing.append(template.id)
+
+        join, policy = cls.join_effective_return_policy(table, table.id)
+        for i in range(0, len(missing), cursor.IN_MAX):
+            cursor.execute(*join.select(
+                table.id, policy,
+                where=reduce_ids(table.id, missing[i:i + cursor.IN_MAX])
+            ))
+            for template_id, policy_id in cursor.fetchall():
+                cls._effective_return_policy_cache.set(template_id, policy_id)
+                result[template_id] = policy_id
+        return result
+
+    @classmethod
+    def write(cls, *args):
+        super(ProductTemplate, cls).write(*args)
+        cls._effective_return_policy_cache.clear()
+
+    @classmethod
+    def delete(cls, templates):
+        super(ProductTemplate, cls).delete(templates)
+        cls._effective_return_policy_cache.clear()
+
+
+class AssignReturnPolicyStart(ModelView):
+    'Assign Return Policy'
+    __name__ = 'sale.return.policy.assign.start'
+
+    target = fields.Selection([
+        ('product.template', 'Products'),
+        ('product.category', 'Categories'),
+    ], 'Apply To', required=True)
+    policy = fields.Many2One(
+        'sale.return.policy', 'Return Policy',
+        help='Leave empty to clear the return policy'
+    )
+    categories = fields.Many2Many(
+        'product.category', None, None, 'Categories',
+        help='Restrict to the products of these categories or to these '
+        'categories, all of them if empty'
+    )
+
+    @staticmethod
+    def default_target():
+        return 'product.template'
+
+
+class AssignReturnPolicy(Wizard):
+    'Assign Return Policy'
+    __name__ = 'sale.return.policy.assign'
+
+    start = StateView(
+        'sale.return.policy.assign.start',
+        'sale_return.return_policy_assign_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Assign', 'assign', 'tryton-ok', default=True),
+        ]
+    )
+    assign = StateTransition()
+
+    def transition_assign(self):
+        Model = Pool().get(self.start.target)
+
+        domain = []
+        if self.start.categories:
+            field = 'category' if self.start.target == 'product.template' \
+                else 'id'
+            domain.append(
+                (field, 'in', [c.id for c in self.start.categories])
+            )
+        Model.assign_return_policy(domain, self.start.policy)
+        return 'end'
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+    profiler.py
+
+"""
+import random
+import threading
+import time
+from functools import wraps
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['profiled', 'get_stats', 'get_report', 'get_folded', 'reset']
+
+_lock = threading.Lock()
+_local = threading.local()
+
+# Calls and wall time in seconds by function name
+_stats = {}
+# Self wall time in seconds by folded stack ("outer;inner")
+_folded = {}
+_settings = {}
+# Stack of the thread during a top level call which is not sampled
+_NOT_SAMPLED = object()
+
+
+def _get_settings():
+    """
+    Returns the profiling options of the sale_return section of the
+    configuration, read once:
+
+        - profile: enable the profiling of all the requests
+        - profile_sample_rate: ratio of the top level calls which are timed
+        - profile_report: path of the text report
+        - profile_flamegraph: path of the report in folded stack format
+        - profile_report_interval: seconds between two reports
+    """
+    if not _settings:
+        def get(option, default=None):
+            return config.get('sale_return', option) or default
+        _settings.update({
+            'enabled': get('profile', 'False') in ('True', 'true', '1'),
+            'sample_rate': float(get('profile_sample_rate', 0.01)),
+            'report': get('profile_report'),
+            'flamegraph': get('profile_flamegraph'),
+            'interval': float(get('profile_report_interval', 60)),
+            'last_report': time.time(),
+        })
+    return _settings
+
+
+def _is_sampled():
+    """
+    Returns True if the top level call must be timed
+    """
+    if Transaction().context.get('sale_return_profile'):
+        return True
+    settings = _get_settings()
+    return settings['enabled'] and random.random() < settings['sample_rate']
+
+
+def profiled(name):
+    """
+    Decorate a function to sample its wall time under name.
+
+    It is timed when the configuration enables the profiling or the context
+    has sale_return_profile, for a ratio of the top level calls given by
+    profile_sample_rate (all of them with the context). The calls nested in
+    a timed call are always timed to keep the stacks complete, and those
+    nested in a call which is not timed never are.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            stack = getattr(_local, 'stack', None)
+            if stack is _NOT_SAMPLED:
+                return func(*args, **kwargs)
+            if not stack:
+                if not _is_sampled():
+                    # The nested calls are not sampled on their own
+                    _local.stack = _NOT_SAMPLED
+                    try:
+                        return func(*args, **kwargs)
+                    finally:
+                        _local.stack = None
+                stack = _local.stack = []
+
+            frame = [name, 0.]
+            stack.append(frame)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                folded = ';'.join(f[0] for f in stack)
+                stack.pop()
+                if stack:
+                    stack[-1][1] += elapsed
+                _record(name, folded, elapsed, elapsed - frame[1])
+                if not stack:
+                    _report()
+        return wrapper
+    return decorator
+
+
+def _record(name, folded, elapsed, self_elapsed):
+    with _lock:
+        stats = _stats.setdefault(name, [0, 0.])
+        stats[0] += 1
+        stats[1] += elapsed
+        _folded[folded] = _folded.get(folded, 0.) + self_elapsed
+
+
+def _report():
+    """
+    Write the reports if the report interval is elapsed
+    """
+    settings = _get_settings()
+    if not settings['report'] and not settings['flamegraph']:
+        return
+    now = time.time()
+    with _lock:
+        if now - settings['last_report'] < settings['interval']:
+            return
+        settings['last_report'] = now
+    for path, content in [
+            (settings['report'], get_report()),
+            (settings['flamegraph'], get_folded())]:
+        if path:
+            with open(path, 'w') as report_file:
+                report_file.write(content)
+
+
+def get_stats():
+    """
+    Returns the number of calls and the wall time of each function as a
+    dictionary of tuples
+    """
+    with _lock:
+        return dict((k, tuple(v)) for k, v in _stats.iteritems())
+
+
+def get_report():
+    """
+    Returns the text report of the functions by descending wall time
+    """
+    stats = sorted(
+        get_stats().iteritems(), key=lambda s: s[1][1], reverse=True
+    )
+    lines = ['%-50s %10s %12s %12s' % (
+        'function', 'calls', 'total (ms)', 'mean (ms)'
+    )]
+    for name, (calls, total) in stats:
+        lines.append('%-50s %10d %12.1f %12.3f' % (
+            name, calls, total * 1000, total * 1000 / calls
+        ))
+    return '\n'.join(lines) + '\n'
+
+
+def get_folded():
+    """
+    Returns the self wall time of the stacks in microseconds in the folded
+    format of flamegraph.pl
+    """
+    with _lock:
+        folded = sorted(_folded.iteritems())
+    return ''.join(
+        '%s %d\n' % (stack, round(elapsed * 1000000))
+        for stack, elapsed in folded
+    )
+
+
+def reset():
+    """
+    Clear the statistics and read the configuration again
+    """
+    with _lock:
+        _stats.clear()
+        _folded.clear()
+        _settings.clear()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+    replica.py
+
+"""
+import logging
+from contextlib import contextmanager
+
+from trytond import backend
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['reporting_cursor']
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def reporting_cursor():
+    """
+    Yields the cursor on which the reporting queries of the module run.
+
+    It is a cursor on the read-only replica when the context has
+    sale_return_replica and the replica_database option of the sale_return
+    section of the configuration is set, else or if the replica can not be
+    reached the cursor of the transaction on the primary database.
+    """
+    transaction = Transaction()
+
+    database_name = config.get('sale_return', 'replica_database')
+    if not database_name or \
+            not transaction.context.get('sale_return_replica'):
+        yield transaction.cursor
+        return
+
+    Database = backend.get('Database')
+    try:
+        cursor = Database(database_name).connect().cursor()
+    except Exception:
+        logger.warning(
+            'Unable to connect to the replica "%s", using the primary',
+            database_name, exc_info=True
+        )
+        yield transaction.cursor
+        return
+
+    try:
+        yield cursor
+    finally:
+        cursor.close()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+    return_audit.py
+
+"""
+import csv
+import json
+import os
+from collections import namedtuple
+
+from sql.operators import In
+
+from trytond.model import Model
+from trytond.pool import Pool, PoolMeta
+
+from replica import reporting_cursor
+
+__all__ = ['ReturnAudit']
+__metaclass__ = PoolMeta
+
+AuditLine = namedtuple('AuditLine', [
+    'id', 'sale', 'origin', 'reason', 'date',
+])
+
+VIOLATIONS = ['no_policy', 'reason_not_allowed', 'late', 'not_shipped']
+
+
+class ReturnAudit(Model):
+    """
+    Sale Return Audit
+
+    Streams the confirmed return lines in chunks ordered by id and checks
+    each of them against the return policy of its origin at the time of
+    sale: the return reason must have a term and the return must be dated
+    within the days since sale or shipping of one of those terms. A return
+    under terms counting from a shipping which never happened is reported
+    as not_shipped rather than late, as it has no deadline.
+
+    The policy version of the origin line is used when it is set, else the
+    current terms of its return policy.
+    """
+    __name__ = 'sale.return.audit'
+
+    @classmethod
+    def audit(
+            cls, violation_file=None, chunk_size=1000, checkpoint_path=None):
+        """
+        Audit the return lines by chunks of chunk_size lines so that memory
+        usage does not depend on the number of returns.
+
+        :param violation_file: File like object on which the violations are
+                               reported as CSV, the header is only written
+                               when the audit starts so that a resumed
+                               audit can append to the same file
+        :param chunk_size: Number of return lines read per query
+        :param checkpoint_path: Path of a file storing the id of the last
+                                audited line and the counters, the audit
+                                resumes after it and updates it after each
+                                chunk
+        :return: A dictionary with the number of audited lines, compliant
+                 lines and lines by violation and the last audited line id,
+                 including those of the runs before the checkpoint
+        """
+        SaleLine = Pool().get('sale.line')
+
+        result = dict.fromkeys(['lines', 'compliant'] + VIOLATIONS, 0)
+        result['checkpoint'] = 0
+        if checkpoint_path:
+            result.update(cls._read_checkpoint(checkpoint_path))
+        last_id = result['checkpoint']
+
+        if violation_file is not None:
+            violation_writer = csv.writer(violation_file)
+            if not last_id:
+                violation_writer.writerow([
+                    'line', 'sale', 'origin', 'policy', 'reason', 'date',
+                    'deadline', 'violation',
+                ])
+
+        while True:
+            lines = cls._get_lines(last_id, chunk_size)
+            if not lines:
+                break
+            origins = SaleLine.get_return_origins([l.origin for l in lines])
+            violations = cls._check_chunk(lines, origins)
+
+            result['lines'] += len(lines)
+            result['compliant'] += len(lines) - len(violations)
+            for line, origin, deadline, violation in violations:
+                result[violation] += 1
+                if violation_file is not None:
+                    violation_writer.writerow([
+                        line.id, line.sale, line.origin,
+                        origin.policy if origin else '',
+                        line.reason or '', line.date or '',
+                        deadline or '', violation,
+                    ])
+
+            last_id = result['checkpoint'] = lines[-1].id
+            if checkpoint_path:
+                cls._write_checkpoint(checkpoint_path, result)
+        return result
+
+    @staticmethod
+    def _read_checkpoint(path):
+        """
+        Returns the counters and the last audited line id stored in the
+        checkpoint file, nothing if the audit has not started yet
+        """
+        if not os.path.exists(path):
+            return {}
+        with open(path) as checkpoint_file:
+            content = checkpoint_file.read().strip()
+        return json.loads(content) if content else {}
+
+    @staticmethod
+    def _write_checkpoint(path, result):
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w') as checkpoint_file:
+            checkpoint_file.write(json.dumps(result, sort_keys=True) + '\n')
+        os.rename(temporary_path, path)
+
+    @classmethod
+    def _get_lines(cls, last_id, limit):
+        """
+        Returns the next confirmed return lines after last_id as AuditLine
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        sale = Sale.__table__()
+
+        line, join, condition = SaleLine._get_return_query()
+        join = join.join(sale, condition=line.sale == sale.id)
+        with reporting_cursor() as cursor:
+            cursor.execute(*join.select(
+                line.id, line.sale, line.origin, line.return_reason,
+                sale.sale_date,
+                where=condition & (line.id > last_id)
+                & In(sale.state, ['confirmed', 'processing', 'done'])
+                & line.origin.like('sale.line,%'),
+                order_by=line.id.asc,
+                limit=limit
+            ))
+            return [
+                AuditLine(
+                    line_id, sale_id, int(origin.split(',')[1]), reason,
+                    date
+                )
+                for line_id, sale_id, origin, reason, date
+                in cursor.fetchall()
+            ]
+
+    @classmethod
+    def _check_chunk(cls, lines, origins):
+        """
+        Returns the violations of the lines as a list of tuples (line,
+        origin, deadline, violation)
+        """
+        SaleLine = Pool().get('sale.line')
+
+        deadlines = SaleLine.get_return_deadlines(origins.values())
+
+        violations = []
+        for line in lines:
+            origin = origins.get(line.origin)
+            origin_deadlines = deadlines.get(line.origin)
+            if not origin_deadlines:
+                violations.append((line, origin, None, 'no_policy'))
+            elif line.reason not in origin_deadlines:
+                violations.append(
+                    (line, origin, None, 'reason_not_allowed')
+                )
+            else:
+                deadline = origin_deadlines[line.reason]
+                if deadline is None:
+                    violations.append(
+                        (line, origin, None, 'not_shipped')
+                    )
+                elif line.date is not None and line.date > deadline:
+                    violations.append((line, origin, deadline, 'late'))
+        return violations
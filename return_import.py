@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+"""
+    return_import.py
+
+"""
+import csv
+import json
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from trytond.model import Model
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+
+from sale import DEFAULT_RMA_CHANNEL
+
+__all__ = ['ReturnImport']
+__metaclass__ = PoolMeta
+
+
+class ReturnImport(Model):
+    """
+    Sale Return Import
+
+    Streams returns (RMA) from a CSV or JSON Lines file and creates the
+    return sales chunk by chunk. Each row references the original sale line
+    (origin), the name of the return reason (reason), the return type
+    (return_type) and optionally the returned quantity (quantity).
+
+    Rows may also carry the channel (rma_channel) and the reference
+    (rma_reference) of the RMA in the marketplace. Rows whose RMA was
+    already imported are skipped, or update the existing return line.
+    """
+    __name__ = 'sale.return.import'
+
+    @classmethod
+    def __setup__(cls):
+        super(ReturnImport, cls).__setup__()
+        cls._error_messages.update({
+            'invalid_format': 'Unknown import format "%s".',
+            'origin_not_found': 'Origin sale line "%s" not found.',
+            'origin_not_returnable':
+                'Origin sale line "%s" can not be returned.',
+            'reason_not_found': 'Return reason "%s" not found.',
+            'invalid_return_type': 'Invalid return type "%s".',
+            'invalid_quantity': 'Invalid quantity "%s".',
+            'invalid_row': 'Invalid row: %s',
+        })
+
+    @classmethod
+    def _read_rows(cls, fileobj, format_):
+        """
+        Yields the rows of the file as dictionaries, one at a time. A row
+        which can not be parsed is yielded as a dictionary with the parse
+        error under the _error key, so that it is reported like the other
+        invalid rows.
+        """
+        if format_ == 'csv':
+            reader = csv.DictReader(fileobj)
+            while True:
+                try:
+                    row = next(reader)
+                except StopIteration:
+                    break
+                except csv.Error, exception:
+                    yield {'_error': unicode(exception)}
+                    continue
+                yield cls._decode_row(row)
+        elif format_ == 'jsonl':
+            for line in fileobj:
+                line = line.strip()
+                if line:
+                    yield cls._parse_json_row(line)
+        else:
+            cls.raise_user_error('invalid_format', (format_,))
+
+    @staticmethod
+    def _decode_row(row):
+        """
+        Returns the CSV row with its values decoded from UTF-8
+        """
+        try:
+            return dict(
+                (k, v.decode('utf-8') if isinstance(v, str) else v)
+                for k, v in row.iteritems()
+            )
+        except UnicodeDecodeError, exception:
+            return {'_error': unicode(exception)}
+
+    @staticmethod
+    def _parse_json_row(line):
+        """
+        Returns the row of the JSON line
+        """
+        try:
+            row = json.loads(line)
+        except ValueError, exception:
+            return {'_error': unicode(exception)}
+        if not isinstance(row, dict):
+            return {'_error': u'Not an object'}
+        return row
+
+    @classmethod
+    def import_file(
+            cls, fileobj, format_='csv', chunk_size=500, error_file=None,
+            update_existing=False):
+        """
+        Import the returns of the file, committing after each chunk of
+        chunk_size rows so that memory usage does not depend on the size of
+        the file.
+
+        :param fileobj: File like object to read rows from
+        :param format_: 'csv' or 'jsonl'
+        :param chunk_size: Number of rows created per transaction commit
+        :param error_file: File like object on which the rows in error are
+                           reported as CSV (row number, message)
+        :param update_existing: Update the return lines of the RMA already
+                                imported instead of skipping them
+        :return: A dictionary with the number of rows, created sales,
+                 updated lines, skipped rows and errors
+        """
+        cursor = Transaction().cursor
+
+        if error_file is not None:
+            error_writer = csv.writer(error_file)
+            error_writer.writerow(['row', 'error'])
+
+        result = {
+            'rows': 0, 'sales': 0, 'updated': 0, 'skipped': 0, 'errors': 0,
+        }
+        rows = enumerate(cls._read_rows(fileobj, format_), 1)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            try:
+                sales, updated, skipped, errors = cls._import_chunk(
+                    chunk, update_existing=update_existing
+                )
+                cursor.commit()
+            except Exception, exception:
+                cursor.rollback()
+                sales, updated, skipped = [], [], []
+                message = getattr(exception, 'message', None) or \
+                    unicode(exception)
+                errors = [(number, message) for number, _ in chunk]
+
+            result['rows'] += len(chunk)
+            result['sales'] += len(sales)
+            result['updated'] += len(updated)
+            result['skipped'] += len(skipped)
+            result['errors'] += len(errors)
+            if error_file is not None:
+                for number, message in errors:
+                    error_writer.writerow([number, message.encode('utf-8')])
+        return result
+
+    @classmethod
+    def _get_lookups(cls, rows):
+        """
+        Returns the maps of origin lines by id, return reasons by name and
+        already imported lines by (rma_channel, rma_reference) for the rows
+        of a chunk
+        """
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        ReturnReason = pool.get('sale.return.reason')
+
+        origin_ids = set()
+        reason_names = set()
+        rma_references = set()
+        for _, row in rows:
+            if row.get('rma_reference'):
+                rma_references.add(cls._get_rma_key(row))
+            try:
+                origin_ids.add(int(row.get('origin')))
+            except (TypeError, ValueError):
+                pass
+            if row.get('reason'):
+                reason_names.add(row['reason'])
+
+        origins = dict(
+            (l.id, l) for l in SaleLine.search([
+                ('id', 'in', list(origin_ids)),
+            ])
+        )
+        reasons = dict(
+            (r.name, r) for r in ReturnReason.search([
+                ('name', 'in', list(reason_names)),
+            ])
+        )
+        existing = SaleLine.get_lines_by_rma_reference(rma_references)
+        return origins, reasons, existing
+
+    @staticmethod
+    def _get_rma_key(row):
+        """
+        Returns the (channel, reference) of the RMA of the row or None, the
+        default channel is used for the references without channel
+        """
+        if not row.get('rma_reference'):
+            return None
+        return (
+            row.get('rma_channel') or DEFAULT_RMA_CHANNEL,
+            row['rma_reference']
+        )
+
+    @staticmethod
+    def _skip_rma(rma_key, seen, existing, update_existing):
+        """
+        Returns True if the row of the RMA must be skipped because the RMA
+        is repeated in the file or was already imported, else remembers it
+        """
+        if rma_key is None:
+            return False
+        if rma_key in seen or (rma_key in existing and not update_existing):
+            return True
+        seen.add(rma_key)
+        return False
+
+    @staticmethod
+    def _get_rma_update(line, line_values):
+        """
+        Returns the values to write on the return line already imported for
+        the RMA, or None if it can not be updated anymore
+        """
+        if line.sale.state != 'draft':
+            return None
+        return {
+            'quantity': line_values['quantity'],
+            'return_reason': line_values['return_reason'],
+            'return_type': line_values['return_type'],
+        }
+
+    @classmethod
+    def _import_chunk(cls, rows, update_existing=False):
+        """
+        Create the return sales for a chunk of numbered rows, one return
+        sale per original sale.
+
+        Returns the created sales, the updated lines, the numbers of the
+        skipped rows and the list of errors as (row number, message)
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        origins, reasons, existing = cls._get_lookups(rows)
+
+        errors = []
+        skipped = []
+        to_write = []
+        seen = set()
+        lines_by_sale = {}
+        for number, row in rows:
+            rma_key = cls._get_rma_key(row)
+            if cls._skip_rma(rma_key, seen, existing, update_existing):
+                skipped.append(number)
+                continue
+
+            try:
+                origin, line_values = cls._get_row_values(
+                    row, origins, reasons
+                )
+            except UserError, exception:
+                errors.append((number, exception.message))
+                continue
+            if rma_key is not None:
+                line_values['rma_channel'], line_values['rma_reference'] = \
+                    rma_key
+
+            if rma_key in existing:
+                line = existing[rma_key]
+                values = cls._get_rma_update(line, line_values)
+                if values is None:
+                    skipped.append(number)
+                else:
+                    to_write.extend(([line], values))
+                continue
+
+            lines_by_sale.setdefault(origin.sale, []).append(line_values)
+
+        if to_write:
+            SaleLine.write(*to_write)
+
+        to_create = []
+        for sale, lines in lines_by_sale.iteritems():
+            values = cls._get_return_sale(sale)
+            values['lines'] = [('create', lines)]
+            to_create.append(values)
+        return (
+            Sale.create(to_create), sum(to_write[::2], []), skipped, errors
+        )
+
+    @classmethod
+    def _get_row_values(cls, row, origins, reasons):
+        """
+        Returns the origin line and the values of the return line of the
+        row, or raises a UserError if the row is invalid
+        """
+        SaleLine = Pool().get('sale.line')
+
+        if row.get('_error'):
+            cls.raise_user_error('invalid_row', (row['_error'],))
+
+        try:
+            origin = origins[int(row.get('origin'))]
+        except (KeyError, TypeError, ValueError):
+            cls.raise_user_error('origin_not_found', (row.get('origin'),))
+        if not cls._is_returnable(origin):
+            cls.raise_user_error('origin_not_returnable', (row['origin'],))
+
+        reason = None
+        if row.get('reason'):
+            reason = reasons.get(row['reason'])
+            if reason is None:
+                cls.raise_user_error('reason_not_found', (row['reason'],))
+
+        return_type = row.get('return_type') or \
+            SaleLine.default_return_type()
+        if return_type not in [t for t, _ in SaleLine.return_type.selection]:
+            cls.raise_user_error('invalid_return_type', (return_type,))
+
+        return origin, cls._get_return_line(
+            origin, cls._get_row_quantity(row, origin), reason, return_type
+        )
+
+    @staticmethod
+    def _is_returnable(origin):
+        """
+        Returns True if the origin is a sold line of a product, unlike the
+        comment lines or the return lines
+        """
+        return bool(
+            origin.type == 'line' and origin.product
+            and (origin.quantity or 0) > 0
+        )
+
+    @classmethod
+    def _get_row_quantity(cls, row, origin):
+        """
+        Returns the returned quantity of the row, the quantity of the origin
+        line by default
+        """
+        if not row.get('quantity'):
+            return origin.quantity
+        try:
+            quantity = float(Decimal(str(row['quantity'])))
+        except InvalidOperation:
+            quantity = None
+        if not quantity or quantity < 0:
+            cls.raise_user_error('invalid_quantity', (row['quantity'],))
+        return quantity
+
+    @classmethod
+    def _get_return_sale(cls, sale):
+        """
+        Returns the values of the return sale for the original sale
+        """
+        Date = Pool().get('ir.date')
+
+        return {
+            'company': sale.company.id,
+            'party': sale.party.id,
+            'currency': sale.currency.id,
+            'payment_term': sale.payment_term.id,
+            'invoice_address': sale.invoice_address.id,
+            'shipment_address': sale.shipment_address.id,
+            'sale_date': Date.today(),
+            'reference': sale.reference,
+        }
+
+    @classmethod
+    def _get_return_line(cls, origin, quantity, reason, return_type):
+        """
+        Returns the values of the return line for the original line
+        """
+        return {
+            'type': 'line',
+            'product': origin.product.id,
+            'description': origin.description,
+            'quantity': -quantity,
+            'unit': origin.unit.id,
+            'unit_price': origin.unit_price,
+            'taxes': [('add', [t.id for t in origin.taxes])],
+            'origin': '%s,%s' % (origin.__name__, origin.id),
+            'return_policy': (
+                origin.effective_return_policy_at_sale and
+                origin.effective_return_policy_at_sale.id
+            ),
+            'return_reason': reason and reason.id,
+            'return_type': return_type,
+        }
@@ -3,19 +3,97 @@
     sale.py
 
 """
+import datetime
+import multiprocessing
+from collections import namedtuple
+from decimal import Decimal
+from itertools import groupby
+
+from sql import Null, Literal
+from sql.aggregate import Count, Max
+from sql.conditionals import Coalesce
+from sql.operators import In, Concat
+
 from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Bool, And
+from trytond.transaction import Transaction
+from trytond.tools import reduce_ids
+from trytond.rpc import RPC
+from trytond import backend
+
+from replica import reporting_cursor
+from profiler import profiled
 
 __all__ = ['SaleLine', 'SaleConfiguration', 'Sale']
 __metaclass__ = PoolMeta
 
+# The values of a sold line which decide until when it can be returned
+ReturnOrigin = namedtuple('ReturnOrigin', [
+    'id', 'policy', 'version', 'sale_date', 'shipping_date',
+])
+
 STATE = ~And(
     Eval('type') == 'line',
     Bool(Eval('product'))
 )
 DEPENDS = ['type', 'product']
 
+# Channel of the RMA references imported without channel
+DEFAULT_RMA_CHANNEL = 'default'
+
+# Maximum number of lines in a page of return eligibility
+ELIGIBILITY_PAGE_MAX = 1000
+
+
+def _init_confirm_worker():
+    """
+    Forget the transaction and the database connections inherited from the
+    parent process, without closing them as they are still used by the
+    parent, so that each worker starts its own transaction on its own
+    connection
+    """
+    Transaction().__dict__.clear()
+    Database = backend.get('Database')
+    getattr(Database, '_databases', {}).clear()
+
+
+def _confirm_returns_worker(args):
+    """
+    Confirm a partition of return sales in a transaction of its own, each
+    sale being committed or rolled back individually. The sales which are
+    not confirmed because they are not in quotation are reported as failed.
+    """
+    database_name, user, context, sale_ids = args
+
+    pool = Pool(database_name)
+    if database_name not in Pool.database_list():
+        pool.init()
+
+    result = {'confirmed': [], 'failed': []}
+    with Transaction().start(database_name, user, context=context):
+        Sale = pool.get('sale.sale')
+        cursor = Transaction().cursor
+        for sale_id in sale_ids:
+            try:
+                Sale.confirm([Sale(sale_id)])
+                sale = Sale(sale_id)
+                if sale.state != 'confirmed':
+                    Sale.raise_user_error('return_not_quotation', (
+                        sale.rec_name,
+                    ))
+                cursor.commit()
+            except Exception, exception:
+                cursor.rollback()
+                result['failed'].append((
+                    sale_id,
+                    getattr(exception, 'message', None) or
+                    unicode(exception)
+                ))
+            else:
+                result['confirmed'].append(sale_id)
+    return result
+
 
 class SaleLine:
     __name__ = 'sale.line'
@@ -28,6 +106,15 @@ class SaleLine:
         depends=['type']
     )
 
+    return_policy_version = fields.Many2One(
+        'sale.return.policy.version', 'Return Policy Version', readonly=True,
+        ondelete='RESTRICT',
+        states={
+            'invisible': Eval('type') != 'line'
+        },
+        depends=['type']
+    )
+
     effective_return_policy_at_sale = fields.Function(
         fields.Many2One(
             'sale.return.policy', 'Effective Return Policy at Sale',
@@ -41,7 +128,7 @@ class SaleLine:
 
     is_return = fields.Function(
         fields.Boolean('Is Return?'),
-        'get_is_return'
+        'get_is_return', searcher='search_is_return'
     )
 
     origin = fields.Reference(
@@ -86,6 +173,181 @@ class SaleLine:
         'get_returns'
     )
 
+    exchange_of = fields.Many2One(
+        'sale.line', 'Exchange Of', readonly=True, select=True,
+        states={
+            'invisible': ~Bool(Eval('exchange_of')),
+        }
+    )
+
+    return_archived = fields.Boolean('Return Archived', readonly=True)
+    returns_archived = fields.Boolean(
+        'Returns Archived', readonly=True,
+        help='Some returns of the line are archived'
+    )
+
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+
+    rma_channel = fields.Char(
+        'RMA Channel',
+        states={
+            'invisible': STATE,
+            'required': Bool(Eval('rma_reference')),
+        },
+        depends=DEPENDS + ['is_return', 'rma_reference'],
+        help='Required with a reference, so that the reference is unique'
+    )
+    rma_reference = fields.Char(
+        'RMA Reference',
+        states={
+            'invisible': STATE,
+        },
+        depends=DEPENDS + ['is_return']
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(SaleLine, cls).__setup__()
+
+        cls.__rpc__.update({
+            'get_return_eligibility': RPC(readonly=True),
+        })
+        cls._error_messages.update({
+            'eligibility_without_lines':
+                'The return eligibility requires line ids or a party.',
+        })
+        cls._sql_constraints += [
+            ('rma_reference_uniq', 'UNIQUE(rma_channel, rma_reference)',
+                'The RMA reference must be unique per channel.'),
+        ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        ReturnArchive = pool.get('sale.return.archive')
+        cursor = Transaction().cursor
+        sql_table = cls.__table__()
+        sale = Sale.__table__()
+
+        table = TableHandler(cursor, cls, module_name)
+        company_exist = table.column_exist('company')
+        returns_archived_exist = table.column_exist('returns_archived')
+
+        super(SaleLine, cls).__register__(module_name)
+
+        # Migration: fill the company of the lines from their sale
+        if not company_exist:
+            cursor.execute(*sql_table.update(
+                columns=[sql_table.company],
+                values=[sale.select(
+                    sale.company, where=sale.id == sql_table.sale
+                )]
+            ))
+
+        # Migration: give the default channel to the RMA references without
+        # channel, unless they would not be unique
+        unique = cls.__table__()
+        default = cls.__table__()
+        cursor.execute(*sql_table.update(
+            columns=[sql_table.rma_channel],
+            values=[DEFAULT_RMA_CHANNEL],
+            where=(sql_table.rma_channel == Null)
+            & In(sql_table.rma_reference, unique.select(
+                unique.rma_reference,
+                where=(unique.rma_channel == Null)
+                & (unique.rma_reference != Null),
+                group_by=unique.rma_reference,
+                having=Count(Literal(1)) == 1
+            ))
+            & ~In(sql_table.rma_reference, default.select(
+                default.rma_reference,
+                where=default.rma_channel == DEFAULT_RMA_CHANNEL
+            ))
+        ))
+
+        # Migration: flag the origins of the returns already archived
+        if not returns_archived_exist:
+            archive = ReturnArchive.__table__()
+            cursor.execute(*sql_table.update(
+                columns=[sql_table.returns_archived],
+                values=[True],
+                where=In(
+                    Concat(cls.__name__ + ',', sql_table.id),
+                    archive.select(archive.origin)
+                )
+            ))
+
+        cls._register_return_index()
+
+    @classmethod
+    def _register_return_index(cls):
+        """
+        Create the index of the return lookups on the lines which are not
+        archived only, so that it does not grow with the closed history
+        """
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        index_name = '%s_company_origin_return_index' % cls._table
+
+        if backend.name() == 'postgresql':
+            cursor.execute(
+                'SELECT 1 FROM pg_indexes WHERE indexname = %s',
+                (index_name,)
+            )
+        elif backend.name() == 'sqlite':
+            cursor.execute(
+                'SELECT 1 FROM sqlite_master '
+                'WHERE type = \'index\' AND name = ?', (index_name,)
+            )
+        else:
+            table = TableHandler(cursor, cls)
+            table.index_action(['company', 'origin'], 'add')
+            return
+        if not cursor.fetchone():
+            cursor.execute(
+                'CREATE INDEX "%s" ON "%s" ("company", "origin") '
+                'WHERE NOT "return_archived"' % (index_name, cls._table)
+            )
+
+    @classmethod
+    def create(cls, vlist):
+        """
+        Set the company of the lines from their sale
+        """
+        Sale = Pool().get('sale.sale')
+
+        sale_ids = list(set(v['sale'] for v in vlist if v.get('sale')))
+        companies = dict((s.id, s.company.id) for s in Sale.browse(sale_ids))
+
+        vlist = [v.copy() for v in vlist]
+        for values in vlist:
+            if values.get('sale'):
+                values['company'] = companies[values['sale']]
+        return super(SaleLine, cls).create(vlist)
+
+    @classmethod
+    def copy(cls, lines, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default.setdefault('rma_reference', None)
+        default.setdefault('exchange_of', None)
+        default.setdefault('return_archived', False)
+        default.setdefault('returns_archived', False)
+        default.setdefault('return_policy_version', None)
+        default.setdefault('company', None)
+        return super(SaleLine, cls).copy(lines, default=default)
+
+    @staticmethod
+    def default_return_archived():
+        return False
+
+    @staticmethod
+    def default_returns_archived():
+        return False
+
     @staticmethod
     def default_return_type():
         return 'credit'
@@ -100,25 +362,126 @@ class SaleLine:
         return sale_config.default_return_policy and \
             sale_config.default_return_policy.id
 
-    def get_effective_return_policy_at_sale(self, name):
+    @classmethod
+    @profiled('sale.line.get_effective_return_policy_at_sale')
+    def get_effective_return_policy_at_sale(cls, lines, name):
         """
         Returns the sale's return policy if there, else the effective return
         policy of product
         """
-        if self.return_policy_at_sale:
-            return self.return_policy_at_sale.id
-        if self.product and self.product.effective_return_policy:
-            return self.product.effective_return_policy.id
+        line = cls.__table__()
+
+        join, policy = cls.join_effective_return_policy_at_sale(line)
+        result = dict((l.id, None) for l in lines)
+        line_ids = result.keys()
+        with reporting_cursor() as cursor:
+            for i in range(0, len(line_ids), cursor.IN_MAX):
+                sub_ids = line_ids[i:i + cursor.IN_MAX]
+                cursor.execute(*join.select(
+                    line.id, policy,
+                    where=reduce_ids(line.id, sub_ids)
+                ))
+                result.update(cursor.fetchall())
+        return result
+
+    @classmethod
+    def join_effective_return_policy_at_sale(cls, line, query=None):
+        """
+        Returns the query of the line table, line by default, left joined
+        with the products of the lines, and the expression of the effective
+        return policy at sale of the lines
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        product = Product.__table__()
+
+        if query is None:
+            query = line
+        query, policy = Template.join_effective_return_policy(
+            query.join(
+                product, 'LEFT', condition=line.product == product.id
+            ),
+            product.template
+        )
+        return query, Coalesce(line.return_policy_at_sale, policy)
 
-    def get_is_return(self, name=None):
+    def _is_return(self):
         """
         Returns True if it's a Return Sale Line
         """
-        return (
+        return bool(
             self.type == 'line' and self.product and
             self.product.type == 'goods' and self.quantity < 0
         )
 
+    @classmethod
+    def _get_return_query(cls):
+        """
+        Returns the sale line table, its join with the products and their
+        templates and the condition of the Return Sale Lines
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        line = cls.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+
+        join = line.join(
+            product, condition=line.product == product.id
+        ).join(
+            template, condition=product.template == template.id
+        )
+        condition = (
+            (line.type == 'line')
+            & (template.type == 'goods')
+            & (line.quantity < 0)
+        )
+        return line, join, condition
+
+    @classmethod
+    @profiled('sale.line.get_is_return')
+    def get_is_return(cls, lines, name):
+        """
+        Returns True for the Return Sale Lines, computed for all the lines
+        with one query joining the products and their templates
+        """
+        line, join, condition = cls._get_return_query()
+
+        result = dict((l.id, False) for l in lines)
+        line_ids = result.keys()
+        with reporting_cursor() as cursor:
+            for i in range(0, len(line_ids), cursor.IN_MAX):
+                sub_ids = line_ids[i:i + cursor.IN_MAX]
+                cursor.execute(*join.select(
+                    line.id,
+                    where=reduce_ids(line.id, sub_ids) & condition
+                ))
+                result.update((r[0], True) for r in cursor.fetchall())
+        return result
+
+    @classmethod
+    def search_is_return(cls, name, clause):
+        """
+        Search return lines, mirrors the condition of get_is_return
+        """
+        _, operator, value = clause
+        domain = [
+            ('type', '=', 'line'),
+            ('product.type', '=', 'goods'),
+            ('quantity', '<', 0),
+        ]
+        if (operator == '=') == bool(value):
+            return domain
+        return [
+            'OR',
+            ('type', '!=', 'line'),
+            ('product', '=', None),
+            ('product.type', '!=', 'goods'),
+            ('quantity', '>=', 0),
+        ]
+
     @classmethod
     def _get_origin(cls):
         'Return list of Model names for origin Reference'
@@ -135,15 +498,17 @@ class SaleLine:
         return [(None, '')] + [(m.model, m.name) for m in models]
 
     @fields.depends('type')
+    @profiled('sale.line.on_change_quantity')
     def on_change_quantity(self):
         res = super(SaleLine, self).on_change_quantity()
 
         if not self.product:
             return res
 
-        res['is_return'] = self.get_is_return()
+        res['is_return'] = self._is_return()
         return res
 
+    @profiled('sale.line.on_change_product')
     def on_change_product(self):
         res = super(SaleLine, self).on_change_product()
 
@@ -157,6 +522,7 @@ class SaleLine:
         return res
 
     @fields.depends('origin')
+    @profiled('sale.line.on_change_origin')
     def on_change_origin(self):
         """
         Fill the return policy if the origin is a sale line
@@ -173,18 +539,436 @@ class SaleLine:
             'return_policy': None
         }
 
-    def get_returns(self, name):
+    @classmethod
+    @profiled('sale.line.get_returns')
+    def get_returns(cls, lines, name):
         """
-        Returns the return lines for a sale line
+        Returns the return lines for the sale lines
         """
-        SaleLine = Pool().get('sale.line')
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        ReturnArchive = pool.get('sale.return.archive')
+        line = cls.__table__()
+        sale = Sale.__table__()
+
+        result = dict((l.id, []) for l in lines)
+        origins = dict(('%s,%s' % (cls.__name__, l.id), l) for l in lines)
+        companies = list(set(l.sale.company.id for l in lines))
+        origin_keys = origins.keys()
+        with reporting_cursor() as cursor:
+            for i in range(0, len(origin_keys), cursor.IN_MAX):
+                cursor.execute(*line.join(
+                    sale, condition=line.sale == sale.id
+                ).select(
+                    line.origin, line.company, sale.party, line.id,
+                    where=In(line.company, companies)
+                    & In(line.origin, origin_keys[i:i + cursor.IN_MAX])
+                    & (sale.state != 'cancel')
+                    & ~line.return_archived,
+                    order_by=line.id
+                ))
+                for origin, company, party, line_id in cursor.fetchall():
+                    orig_line = origins[origin]
+                    if (company == orig_line.sale.company.id
+                            and party == orig_line.sale.party.id):
+                        result[orig_line.id].append(line_id)
+
+        for orig_line in lines:
+            if ReturnArchive.is_archived(orig_line):
+                result[orig_line.id] += ReturnArchive.get_archived_lines(
+                    orig_line, party=orig_line.sale.party
+                )
+        return result
+
+    def _get_same_origin_query(self, party=None):
+        """
+        Returns the query of the ids of the other lines which are not
+        archived and have the same origin as this line in its company, the
+        sales are only joined to filter on the party
+        """
+        Sale = Pool().get('sale.sale')
+        line = self.__table__()
+        sale = Sale.__table__()
+
+        condition = (
+            (line.company == self.sale.company.id)
+            & (line.origin == '%s,%s' % (
+                self.origin.__name__, self.origin.id))
+            & (line.id != self.id)
+            & ~line.return_archived
+        )
+        if party is None:
+            return line.select(line.id, where=condition, order_by=line.id)
+        return line.join(
+            sale, condition=line.sale == sale.id
+        ).select(
+            line.id, where=condition & (sale.party == int(party)),
+            order_by=line.id
+        )
+
+    def get_lines_with_same_origin(self, party=None):
+        """
+        Returns the ids of the other lines of the party which have the same
+        origin as this line. If party is None, the lines of all the parties
+        of the company are returned with a single probe of the
+        (company, origin) index.
+        """
+        ReturnArchive = Pool().get('sale.return.archive')
+        cursor = Transaction().cursor
+
+        cursor.execute(*self._get_same_origin_query(party))
+        lines = [r[0] for r in cursor.fetchall()]
+        if ReturnArchive.is_archived(self.origin):
+            lines += ReturnArchive.get_archived_lines(
+                self.origin, party=party
+            )
+        return lines
+
+    @classmethod
+    def _get_credit_note_grouping_key(cls, line):
+        """
+        Returns the key used to group return lines into a single credit
+        note, the lines of a group share all the values the credit note
+        takes from their sales
+        """
+        return (
+            line.sale.company.id, line.sale.party.id, line.sale.currency.id,
+            line.sale.invoice_address.id, line.sale.payment_term.id,
+        )
+
+    @classmethod
+    def create_credit_notes(cls, lines):
+        """
+        Create credit notes in bulk for return lines with return type
+        'credit' of the sales which are not invoiced manually. Lines are
+        grouped by company, party, currency, invoice address and payment
+        term and one credit note is created per group.
+
+        Returns the list of created credit notes
+        """
+        Invoice = Pool().get('account.invoice')
+
+        lines = [
+            l for l in lines
+            if l.is_return and l.return_type == 'credit'
+            and l.sale.state in ('confirmed', 'processing')
+            and l.sale.invoice_method != 'manual'
+        ]
+        lines.sort(key=cls._get_credit_note_grouping_key)
+
+        credit_notes = []
+        for _, grouped_lines in groupby(
+                lines, key=cls._get_credit_note_grouping_key):
+            grouped_lines = list(grouped_lines)
+            invoice_lines = []
+            for line in grouped_lines:
+                invoice_lines.extend(line.get_invoice_line('out_credit_note'))
+            if not invoice_lines:
+                continue
+
+            sale = grouped_lines[0].sale
+            if not sale.party.account_receivable:
+                sale.raise_user_error('missing_account_receivable', (
+                    sale.party.rec_name,
+                ))
+            credit_note = sale._get_invoice_sale('out_credit_note')
+            credit_note.reference = ', '.join(sorted(set(
+                l.sale.reference for l in grouped_lines if l.sale.reference
+            ))) or None
+            credit_note.lines = invoice_lines
+            credit_notes.append(credit_note)
+
+        if not credit_notes:
+            return []
+        credit_notes = Invoice.create([c._save_values for c in credit_notes])
+        Invoice.update_taxes(credit_notes)
+        return credit_notes
+
+    @classmethod
+    @profiled('sale.line.set_return_policy_version')
+    def set_return_policy_version(cls, lines):
+        """
+        Set on the lines the version in force of their effective return
+        policy at sale
+        """
+        Version = Pool().get('sale.return.policy.version')
+
+        lines = [
+            l for l in lines
+            if l.type == 'line' and not l.return_policy_version
+            and l.effective_return_policy_at_sale
+        ]
+        versions = Version.get_current_versions(set(
+            l.effective_return_policy_at_sale for l in lines
+        ))
 
-        lines = SaleLine.search([
-            ('sale.party', '=', self.sale.party),
-            ('origin', '=', '%s,%s' % (self.__name__, self.id)),
-            ('sale.state', '!=', 'cancel'),
+        lines_by_version = {}
+        for line in lines:
+            version = versions.get(line.effective_return_policy_at_sale.id)
+            if version:
+                lines_by_version.setdefault(version.id, []).append(line)
+        to_write = []
+        for version_id, version_lines in lines_by_version.iteritems():
+            to_write.extend((version_lines, {
+                'return_policy_version': version_id,
+            }))
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    def get_lines_by_rma_reference(cls, references):
+        """
+        Returns a dictionary of the lines by (channel, reference) for the
+        given (channel, reference) pairs, using a single search on the
+        unique RMA reference index
+        """
+        references_by_channel = {}
+        for channel, reference in references:
+            references_by_channel.setdefault(channel, set()).add(reference)
+        if not references_by_channel:
+            return {}
+
+        domain = ['OR']
+        for channel, channel_references in references_by_channel.iteritems():
+            domain.append([
+                ('rma_channel', '=', channel),
+                ('rma_reference', 'in', list(channel_references)),
+            ])
+        return dict(
+            ((l.rma_channel, l.rma_reference), l) for l in cls.search(domain)
+        )
+
+    @classmethod
+    def get_return_origins(cls, line_ids):
+        """
+        Returns the ReturnOrigin of the lines by id, with their effective
+        return policy at sale, its version, the date of their sale and of
+        their last done move
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Move = pool.get('stock.move')
+        line = cls.__table__()
+        sale = Sale.__table__()
+        move = Move.__table__()
+
+        join, policy = cls.join_effective_return_policy_at_sale(
+            line, line.join(sale, condition=line.sale == sale.id)
+        )
+        line_ids = sorted(set(line_ids))
+        rows = {}
+        shipping_dates = {}
+        with reporting_cursor() as cursor:
+            for i in range(0, len(line_ids), cursor.IN_MAX):
+                sub_ids = line_ids[i:i + cursor.IN_MAX]
+                cursor.execute(*join.select(
+                    line.id, policy, line.return_policy_version,
+                    sale.sale_date,
+                    where=reduce_ids(line.id, sub_ids)
+                ))
+                rows.update((r[0], r) for r in cursor.fetchall())
+
+                cursor.execute(*move.select(
+                    move.origin, Max(move.effective_date),
+                    where=In(
+                        move.origin,
+                        ['%s,%s' % (cls.__name__, l) for l in sub_ids]
+                    ) & (move.state == 'done'),
+                    group_by=move.origin
+                ))
+                shipping_dates.update(
+                    (int(origin.split(',')[1]), date)
+                    for origin, date in cursor.fetchall()
+                )
+        return dict(
+            (line_id, ReturnOrigin(*row + (shipping_dates.get(line_id),)))
+            for line_id, row in rows.iteritems()
+        )
+
+    @classmethod
+    def get_return_deadlines(cls, origins):
+        """
+        Returns for each ReturnOrigin by id the last date of return of each
+        reason allowed by the terms of its policy version, or of its policy
+        when it has no version. The deadline of a reason is None when the
+        date its terms count from is not known yet, like the shipping date
+        of a line which is not shipped.
+        """
+        Version = Pool().get('sale.return.policy.version')
+
+        terms = Version.get_origin_terms(origins)
+        result = {}
+        for origin in origins:
+            deadlines = result[origin.id] = {}
+            for reason, days, since in terms[origin.id]:
+                since_date = origin.sale_date if since == 'sale' \
+                    else origin.shipping_date
+                deadline = since_date + datetime.timedelta(days) \
+                    if since_date else None
+                deadlines[reason] = max(deadlines.get(reason), deadline)
+        return result
+
+    @classmethod
+    def get_return_eligibility(
+            cls, ids=None, party=None, from_date=None, to_date=None,
+            offset=0, limit=ELIGIBILITY_PAGE_MAX, date=None):
+        """
+        Returns a page of the return eligibility of the lines given by ids
+        or of the lines sold to the party between from_date and to_date, as
+        a dictionary with the total number of lines and, for the lines of
+        the page, a list of dictionaries with:
+
+            - id: the id of the line
+            - policy: the effective return policy at sale
+            - version: the version of the policy in force at sale
+            - eligible: True if it can be returned for one of the reasons
+            - deadline: the last date of return for any reason
+            - reasons: the eligibility and deadline of each allowed reason
+
+        The policies, terms and dates of the page are read with a few
+        queries, whatever the number of lines.
+        """
+        Date = Pool().get('ir.date')
+
+        if date is None:
+            date = Date.today()
+        limit = min(limit or ELIGIBILITY_PAGE_MAX, ELIGIBILITY_PAGE_MAX)
+
+        if ids is not None:
+            domain = [
+                ('id', 'in', list(set(ids))),
+            ]
+        elif party is not None:
+            domain = [
+                ('type', '=', 'line'),
+                ('is_return', '=', False),
+                ('sale.party', '=', party),
+                ('sale.state', 'in', ['confirmed', 'processing', 'done']),
+            ]
+            if from_date:
+                domain.append(('sale.sale_date', '>=', from_date))
+            if to_date:
+                domain.append(('sale.sale_date', '<=', to_date))
+        else:
+            cls.raise_user_error('eligibility_without_lines')
+        # The total and the page only count the lines the user can read
+        total = cls.search_count(domain)
+        lines = cls.search(
+            domain, offset=offset, limit=limit, order=[('id', 'ASC')]
+        )
+
+        origins = cls.get_return_origins([l.id for l in lines])
+        line_deadlines = cls.get_return_deadlines(origins.values())
+
+        result = []
+        for line in lines:
+            origin = origins[line.id]
+            deadlines = line_deadlines[line.id]
+            reasons = [{
+                'reason': reason_id,
+                'eligible': (
+                    reason_deadline is not None and reason_deadline >= date
+                ),
+                'deadline': reason_deadline,
+            } for reason_id, reason_deadline in sorted(
+                deadlines.iteritems())]
+            result.append({
+                'id': line.id,
+                'policy': origin.policy,
+                'version': origin.version,
+                'eligible': any(r['eligible'] for r in reasons),
+                'deadline': max([None] + deadlines.values()),
+                'reasons': reasons,
+            })
+        return {
+            'total': total,
+            'offset': offset,
+            'limit': limit,
+            'lines': result,
+        }
+
+    def _get_exchange_price_key(self):
+        """
+        Returns the key under which the price of the replacement line is
+        cached for a batch
+        """
+        context = self._get_context_sale_price()
+        return tuple(sorted(
+            (k, tuple(v) if isinstance(v, list) else v)
+            for k, v in context.iteritems()
+        )) + (('quantity', -self.quantity),)
+
+    def _get_exchange_line(self, unit_price):
+        """
+        Returns the values of the replacement line for this exchange line
+        """
+        return {
+            'sale': self.sale.id,
+            'type': 'line',
+            'product': self.product.id,
+            'description': self.description,
+            'quantity': -self.quantity,
+            'unit': self.unit.id,
+            'unit_price': unit_price.quantize(
+                Decimal(1) / 10 ** self.__class__.unit_price.digits[1]
+            ),
+            'taxes': [('add', [t.id for t in self.taxes])],
+            'return_policy_at_sale': (
+                self.return_policy_at_sale and self.return_policy_at_sale.id
+            ),
+            'exchange_of': self.id,
+        }
+
+    @classmethod
+    def create_exchange_lines(cls, lines):
+        """
+        Create the replacement lines of the exchange return lines in one
+        pass. The unit price of the original line is reused when the
+        product is unchanged, else prices are computed once per batch for
+        each distinct pricing context.
+
+        Returns the created replacement lines
+        """
+        Product = Pool().get('product.product')
+
+        lines = [
+            l for l in lines
+            if l.is_return and l.return_type == 'exchange'
+            and l.sale.state in ('draft', 'quotation')
+        ]
+        if not lines:
+            return []
+
+        exchanged = set(
+            l.exchange_of.id for l in cls.search([
+                ('exchange_of', 'in', map(int, lines)),
+            ])
+        )
+        lines = [l for l in lines if l.id not in exchanged]
+
+        prices = {}
+        to_price = {}
+        for line in lines:
+            if (isinstance(line.origin, cls) and
+                    line.origin.product == line.product):
+                prices[line.id] = line.origin.unit_price
+            else:
+                to_price.setdefault(
+                    line._get_exchange_price_key(), []
+                ).append(line)
+
+        for key, priced_lines in to_price.iteritems():
+            context = dict(key)
+            quantity = context.pop('quantity')
+            products = list(set(l.product for l in priced_lines))
+            with Transaction().set_context(context):
+                product_prices = Product.get_sale_price(products, quantity)
+            for line in priced_lines:
+                prices[line.id] = product_prices[line.product.id]
+
+        return cls.create([
+            l._get_exchange_line(prices[l.id]) for l in lines
         ])
-        return map(int, lines)
 
 
 class SaleConfiguration:
@@ -193,6 +977,43 @@ class SaleConfiguration:
     default_return_policy = fields.Many2One(
         'sale.return.policy', 'Default Return Policy', required=True)
 
+    return_duplicate_scope = fields.Selection([
+        ('party', 'Party'),
+        ('company', 'Company'),
+    ], 'Duplicate Return Check', required=True,
+        help='Check that a line is not returned twice by the same party or '
+        'by any party of the company')
+
+    return_abuse_window = fields.Integer(
+        'Return Abuse Window',
+        help='Number of days of return history checked for each party'
+    )
+    return_abuse_max_returns = fields.Integer(
+        'Maximum Returns',
+        states={
+            'invisible': ~Bool(Eval('return_abuse_window')),
+        },
+        depends=['return_abuse_window'],
+        help='Maximum number of return sales of a party within the window'
+    )
+    return_abuse_max_amount = fields.Numeric(
+        'Maximum Returned Amount', digits=(16, 2),
+        states={
+            'invisible': ~Bool(Eval('return_abuse_window')),
+        },
+        depends=['return_abuse_window'],
+        help='Maximum returned amount of a party within the window'
+    )
+
+    return_archive_checkpoint = fields.Integer(
+        'Return Archive Checkpoint', readonly=True,
+        help='The return lines up to this id are archived or will never be'
+    )
+
+    @staticmethod
+    def default_return_duplicate_scope():
+        return 'party'
+
 
 class Sale:
     __name__ = 'sale.sale'
@@ -209,30 +1030,300 @@ class Sale:
         cls._error_messages.update({
             'line_with_same_origin':
                 "The line set as origin on Sale Line %s has already been "
-                "returned on Sale #%s."
+                "returned on Sale #%s.",
+            'return_abuse':
+                'Party "%s" has exceeded the return limits with %s returns '
+                'for an amount of %s over the last %s days.',
+            'return_not_quotation':
+                'The return sale "%s" can not be confirmed as it is not in '
+                'quotation.',
+            'return_rule_violation':
+                'The return line "%s" does not fulfill the rules of the '
+                'return policy "%s" for the reason "%s".',
         })
 
-    def get_has_return(self, name):
+    @classmethod
+    def create_exchange_lines(cls, sales):
+        """
+        Create the replacement lines for all the exchange return lines of
+        the sales
+        """
+        SaleLine = Pool().get('sale.line')
+
+        return SaleLine.create_exchange_lines(SaleLine.search([
+            ('sale', 'in', map(int, sales)),
+            ('is_return', '=', True),
+            ('return_type', '=', 'exchange'),
+        ]))
+
+    @classmethod
+    def create_return_credit_notes(cls, sales=None):
+        """
+        Create credit notes for all the confirmed return lines of type
+        'credit' which are not invoiced yet, in batches.
+
+        :param sales: Restrict to the given sales, all sales if None
+        """
+        SaleLine = Pool().get('sale.line')
+        cursor = Transaction().cursor
+
+        domain = [
+            ('is_return', '=', True),
+            ('return_type', '=', 'credit'),
+            ('sale.state', 'in', ['confirmed', 'processing']),
+        ]
+        if sales is not None:
+            domain.append(('sale', 'in', map(int, sales)))
+        line_ids = map(int, SaleLine.search(domain, order=[('id', 'ASC')]))
+
+        credit_notes = []
+        for i in range(0, len(line_ids), cursor.IN_MAX):
+            credit_notes.extend(SaleLine.create_credit_notes(
+                SaleLine.browse(line_ids[i:i + cursor.IN_MAX])
+            ))
+        return credit_notes
+
+    @classmethod
+    def _partition_returns(cls, sales, count):
+        """
+        Split the sales in count partitions of similar size, all the sales
+        of a party being in the same partition so that the duplicate origin
+        checks stay within it.
+
+        Returns the list of partitions as lists of sale ids
+        """
+        sales_by_party = {}
+        for sale in sales:
+            sales_by_party.setdefault(sale.party.id, []).append(sale.id)
+
+        partitions = [[] for _ in range(count)]
+        for party_sales in sorted(
+                sales_by_party.values(), key=len, reverse=True):
+            min(partitions, key=len).extend(party_sales)
+        return [p for p in partitions if p]
+
+    @classmethod
+    def confirm_returns(cls, sales, processes=None):
+        """
+        Confirm a large batch of quoted sales on a pool of processes. The
+        sales are partitioned by party and each partition is confirmed by a
+        worker with its own transaction and database connection, so the
+        sales to confirm must be committed.
+
+        Returns a report with the ids of the confirmed sales and the list
+        of (sale id, error message) of the sales which failed
+        """
+        transaction = Transaction()
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        args = [
+            (
+                transaction.cursor.database_name, transaction.user,
+                transaction.context, partition
+            )
+            for partition in cls._partition_returns(sales, processes)
+        ]
+
+        process_pool = multiprocessing.Pool(
+            processes, initializer=_init_confirm_worker
+        )
+        try:
+            results = process_pool.map(_confirm_returns_worker, args)
+        finally:
+            process_pool.close()
+            process_pool.join()
+
+        report = {'confirmed': [], 'failed': []}
+        for result in results:
+            report['confirmed'].extend(result['confirmed'])
+            report['failed'].extend(result['failed'])
+        return report
+
+    @classmethod
+    @profiled('sale.sale.get_has_return')
+    def get_has_return(cls, sales, name):
         """
         Returns True if there's a return sale line
         """
-        return any((line.is_return for line in self.lines))
+        SaleLine = Pool().get('sale.line')
+        line, join, condition = SaleLine._get_return_query()
+
+        result = dict((s.id, False) for s in sales)
+        sale_ids = result.keys()
+        with reporting_cursor() as cursor:
+            for i in range(0, len(sale_ids), cursor.IN_MAX):
+                sub_ids = sale_ids[i:i + cursor.IN_MAX]
+                cursor.execute(*join.select(
+                    line.sale,
+                    where=reduce_ids(line.sale, sub_ids) & condition,
+                    group_by=line.sale
+                ))
+                result.update((r[0], True) for r in cursor.fetchall())
+        return result
 
     @classmethod
+    @profiled('sale.sale.confirm')
     def confirm(cls, sales):
         """
         Validate for return sale lines, if they fall under return policy
         """
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        ReturnHistory = pool.get('sale.return.history')
+        ReturnEvent = pool.get('sale.return.event')
+
+        states = dict((s.id, s.state) for s in sales)
         super(Sale, cls).confirm(sales)
 
-        cls.validate_sale_for_return(sales)
+        # Write paths must read the primary database
+        with Transaction().set_context(sale_return_replica=False):
+            sales = cls.browse(sales)
+            confirmed = cls._get_transitioned(sales, states, 'confirmed')
+            SaleLine.set_return_policy_version(
+                [l for s in confirmed for l in s.lines]
+            )
+            cls.validate_sale_for_return(confirmed)
+            ReturnHistory.record([s for s in confirmed if s.has_return])
+            ReturnEvent.add('confirmed', confirmed)
+
+    @classmethod
+    @profiled('sale.sale.cancel')
+    def cancel(cls, sales):
+        """
+        Remove the returns of the cancelled sales from the return history
+        """
+        pool = Pool()
+        ReturnHistory = pool.get('sale.return.history')
+        ReturnEvent = pool.get('sale.return.event')
+
+        states = dict((s.id, s.state) for s in sales)
+        super(Sale, cls).cancel(sales)
+
+        # Write paths must read the primary database
+        with Transaction().set_context(sale_return_replica=False):
+            sales = cls.browse(sales)
+            cancelled = cls._get_transitioned(sales, states, 'cancel')
+            ReturnHistory.forget(cancelled)
+            ReturnEvent.add('cancelled', cancelled)
+
+    @staticmethod
+    def _get_transitioned(sales, states, state):
+        """
+        Returns the sales which moved to state from the states they had
+        before the transition, as the workflow skips the sales which can
+        not change state
+        """
+        return [
+            s for s in sales if s.state == state and states[s.id] != state
+        ]
 
     @classmethod
+    @profiled('sale.sale.check_return_abuse')
+    def check_return_abuse(cls, sales):
+        """
+        Check the return history of the parties against the limits of the
+        sale configuration
+        """
+        pool = Pool()
+        SaleConfiguration = pool.get('sale.configuration')
+        ReturnHistory = pool.get('sale.return.history')
+
+        config = SaleConfiguration(1)
+        if not config.return_abuse_window:
+            return
+
+        new_returns = {}
+        for sale in sales:
+            key = (sale.company, sale.party)
+            returns, amount = new_returns.get(key, (0, Decimal('0')))
+            new_returns[key] = (returns + 1, amount + sum(
+                abs(l.amount or Decimal('0'))
+                for l in sale.lines if l.is_return
+            ))
+
+        for (company, party), (returns, amount) in new_returns.iteritems():
+            summary = ReturnHistory.get_summary(
+                party, config.return_abuse_window, company=company
+            )
+            returns += summary['returns']
+            amount += summary['amount']
+            max_returns = config.return_abuse_max_returns
+            max_amount = config.return_abuse_max_amount
+            if (max_returns is not None and returns > max_returns) or (
+                    max_amount is not None and amount > max_amount):
+                cls.raise_user_error('return_abuse', (
+                    party.rec_name, returns, amount,
+                    config.return_abuse_window,
+                ))
+
+    @classmethod
+    @profiled('sale.sale.check_return_rules')
+    def check_return_rules(cls, sales):
+        """
+        Check the return lines against the rules of the terms of their
+        return policy for their reason. The rules are those of the policy
+        version in force at the sale of the origin line, else those of the
+        current return policy. They are compiled once per version or policy
+        and evaluated for all the lines of the sales at once.
+        """
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        ReturnPolicy = pool.get('sale.return.policy')
+        Version = pool.get('sale.return.policy.version')
+        ReturnPolicyTermRule = pool.get('sale.return.policy.term.rule')
+
+        lines = []
+        for line in (l for s in sales for l in s.lines):
+            if not line.is_return or not line.return_reason:
+                continue
+            version = isinstance(line.origin, SaleLine) and \
+                line.origin.return_policy_version
+            if version or line.return_policy:
+                lines.append((line, version or line.return_policy))
+        if not lines:
+            return
+
+        # The versions and the policies are keyed by model as their ids
+        # may be the same
+        predicates = {}
+        for Model in [Version, ReturnPolicy]:
+            predicates.update(
+                ((Model.__name__, k), v)
+                for k, v in Model.get_term_predicates([
+                    p.id for _, p in lines if p.__name__ == Model.__name__
+                ]).iteritems()
+            )
+        facts = ReturnPolicyTermRule.get_line_facts([l for l, _ in lines])
+        for (line, policy), line_facts in zip(lines, facts):
+            term_predicates = predicates[(policy.__name__, policy.id)].get(
+                line.return_reason.id
+            )
+            if term_predicates is None:
+                continue
+            if not any(p(line_facts) for p in term_predicates):
+                cls.raise_user_error('return_rule_violation', (
+                    line.rec_name, policy.rec_name,
+                    line.return_reason.rec_name,
+                ))
+
+    @classmethod
+    @profiled('sale.sale.validate_sale_for_return')
     def validate_sale_for_return(cls, sales):
         """
         Validate sale lines against return policy
         """
-        SaleLine = Pool().get('sale.line')
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        SaleConfiguration = pool.get('sale.configuration')
+
+        if Transaction().context.get('sale_return_replica'):
+            with Transaction().set_context(sale_return_replica=False):
+                return cls.validate_sale_for_return(cls.browse(sales))
+
+        config = SaleConfiguration(1)
+        cls.check_return_abuse([s for s in sales if s.has_return])
+        cls.check_return_rules(sales)
 
         for sale in sales:
             if not sale.has_return:
@@ -244,18 +1335,15 @@ class Sale:
                 if not orig_line:
                     continue
 
-                line_with_same_origin = SaleLine.search([
-                    (
-                        'origin',
-                        '=',
-                        '%s,%s' % (orig_line.__name__, orig_line.id)
-                    ),
-                    ('id', '!=', line.id),
-                    ('sale.party', '=', sale.party.id),
-                ])
+                line_with_same_origin = line.get_lines_with_same_origin(
+                    sale.party
+                    if config.return_duplicate_scope == 'party' else None
+                )
 
                 if line_with_same_origin:
                     cls.raise_user_error(
-                        'line_with_same_origin',
-                        (line.id, line_with_same_origin[0].sale.reference)
+                        'line_with_same_origin', (
+                            line.id,
+                            SaleLine(line_with_same_origin[0]).sale.reference
+                        )
                     )
@@ -3,12 +3,46 @@
     sale_return.py
 
 """
+import datetime
+import json
+import operator
+from collections import namedtuple
+from decimal import Decimal
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from sql.aggregate import Max
+from sql.operators import In as SqlIn
+
 from trytond.model import ModelSQL, ModelView, fields
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval, In
+from trytond.cache import Cache, LRUDict
+from trytond.transaction import Transaction
+from trytond.tools import reduce_ids
+from trytond import backend
 
-__all__ = ['ReturnPolicy', 'ReturnPolicyTerm', 'ReturnReason']
+__all__ = [
+    'ReturnPolicy', 'ReturnPolicyVersion', 'ReturnPolicyTerm',
+    'ReturnPolicyTermRule', 'ReturnReason', 'ReturnHistory', 'ReturnArchive',
+]
 __metaclass__ = PoolMeta
 
+# The values of a return line on which the term rules are evaluated
+ReturnLineFacts = namedtuple('ReturnLineFacts', [
+    'amount', 'quantity', 'product_category', 'party_categories',
+])
+# A row of the in-memory copy of the return policy terms
+PolicyTerm = namedtuple('PolicyTerm', [
+    'id', 'policy', 'reason', 'days', 'since', 'shipping_paid_by_customer',
+])
+# The terms of a return policy version
+VersionTerm = namedtuple('VersionTerm', [
+    'reason', 'days', 'since', 'shipping_paid_by_customer', 'rules',
+])
+
 
 class ReturnPolicy(ModelSQL, ModelView):
     """
@@ -19,6 +53,492 @@ class ReturnPolicy(ModelSQL, ModelView):
     name = fields.Char('Name', required=True, select=True)
     description = fields.Text('Description')
     terms = fields.One2Many('sale.return.policy.term', 'policy', 'Terms')
+    versions = fields.One2Many(
+        'sale.return.policy.version', 'policy', 'Versions', readonly=True
+    )
+
+    # The tables and predicates do not depend on the user or the context
+    _predicates_cache = Cache('sale.return.policy.predicates', context=False)
+    _tables_cache = Cache('sale.return.policy.tables', context=False)
+
+    @classmethod
+    def create(cls, vlist):
+        policies = super(ReturnPolicy, cls).create(vlist)
+        cls.changed(policies)
+        return policies
+
+    @classmethod
+    def write(cls, *args):
+        super(ReturnPolicy, cls).write(*args)
+        cls.changed(sum(args[::2], []))
+
+    @classmethod
+    def copy(cls, policies, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default.setdefault('versions', None)
+        return super(ReturnPolicy, cls).copy(policies, default=default)
+
+    @classmethod
+    def delete(cls, policies):
+        super(ReturnPolicy, cls).delete(policies)
+        cls._predicates_cache.clear()
+        cls._tables_cache.clear()
+
+    @classmethod
+    def changed(cls, policies):
+        """
+        Clear the cached predicates and tables and create a new version of
+        the policies whose terms have changed
+        """
+        Version = Pool().get('sale.return.policy.version')
+
+        cls._predicates_cache.clear()
+        cls._tables_cache.clear()
+
+        policies = cls.browse(list(set(map(int, policies))))
+        current_versions = Version.get_current_versions(policies)
+        to_create = []
+        for policy in policies:
+            snapshot = policy.get_snapshot()
+            current = current_versions.get(policy.id)
+            if current and current.snapshot == snapshot:
+                continue
+            to_create.append({
+                'policy': policy.id,
+                'number': current.number + 1 if current else 1,
+                'snapshot': snapshot,
+            })
+        if to_create:
+            Version.create(to_create)
+
+    def get_snapshot(self):
+        """
+        Returns the terms of the policy serialized as JSON
+        """
+        return json.dumps(sorted(
+            term.get_snapshot() for term in self.terms
+        ), sort_keys=True)
+
+    @classmethod
+    def get_tables(cls):
+        """
+        Returns compact in-memory copies of the return policy, term and
+        reason tables as a dictionary with:
+
+            - policies: the name by policy id
+            - terms: the PolicyTerm by term id
+            - policy_terms: the tuple of term ids by policy id
+            - reasons: the name by reason id
+
+        They are loaded with one query per table and cached until one of
+        the tables is modified.
+        """
+        tables = cls._tables_cache.get('tables')
+        if tables is None:
+            tables = cls._load_tables()
+            cls._tables_cache.set('tables', tables)
+        return tables
+
+    @classmethod
+    def _load_tables(cls):
+        pool = Pool()
+        ReturnPolicyTerm = pool.get('sale.return.policy.term')
+        ReturnReason = pool.get('sale.return.reason')
+        cursor = Transaction().cursor
+        policy = cls.__table__()
+        term = ReturnPolicyTerm.__table__()
+        reason = ReturnReason.__table__()
+
+        cursor.execute(*policy.select(policy.id, policy.name))
+        policies = dict(cursor.fetchall())
+
+        cursor.execute(*term.select(
+            term.id, term.policy, term.reason, term.days, term.since,
+            term.shipping_paid_by_customer,
+            order_by=term.id
+        ))
+        terms = {}
+        policy_terms = {}
+        for row in cursor.fetchall():
+            row = PolicyTerm(*row[:5] + (bool(row[5]),))
+            terms[row.id] = row
+            policy_terms.setdefault(row.policy, []).append(row.id)
+
+        cursor.execute(*reason.select(reason.id, reason.name))
+        reasons = dict(cursor.fetchall())
+
+        return {
+            'policies': policies,
+            'terms': terms,
+            'policy_terms': dict(
+                (k, tuple(v)) for k, v in policy_terms.iteritems()
+            ),
+            'reasons': reasons,
+        }
+
+    @classmethod
+    def warm_cache(cls):
+        """
+        Load the return policy, term and reason tables in the cache
+        """
+        cls.get_tables()
+
+    @classmethod
+    def get_return_windows(cls, reason, version_ids=None):
+        """
+        Returns the return windows of the policies and of the versions for
+        the reason as three tuples: the sorted keys, the days since sale and
+        the days since shipping of each key (-1 if there is no such term).
+        The key of a policy is its id and the key of a version is its id
+        negated. When there are many terms for the reason, the longest
+        applies.
+        """
+        Version = Pool().get('sale.return.policy.version')
+
+        terms = [
+            (t.policy, t) for t in cls.get_tables()['terms'].itervalues()
+            if t.policy is not None
+        ]
+        for version_id, version_terms in Version.get_terms(
+                version_ids or []).iteritems():
+            terms.extend((-version_id, t) for t in version_terms)
+
+        windows = {}
+        for key, term in terms:
+            if term.reason != reason:
+                continue
+            days = windows.setdefault(key, [-1, -1])
+            index = 0 if term.since == 'sale' else 1
+            days[index] = max(days[index], term.days)
+
+        keys = sorted(windows)
+        return (
+            tuple(keys),
+            tuple(windows[k][0] for k in keys),
+            tuple(windows[k][1] for k in keys),
+        )
+
+    @classmethod
+    def get_eligibility(
+            cls, policy_ids, reason, sale_dates, shipping_dates, date=None,
+            version_ids=None):
+        """
+        Returns for each line given by its policy id, its sale date and its
+        shipping date, if it can still be returned for the reason and until
+        which date, as two lists of booleans and dates (None when there is
+        no applicable term).
+
+        The terms are those of the policy version of the line in
+        version_ids when it has one, else the current terms of its policy,
+        like for sale.line get_return_eligibility.
+
+        The computation is vectorized with numpy when it is installed.
+        """
+        Date = Pool().get('ir.date')
+
+        if date is None:
+            date = Date.today()
+        if version_ids is None:
+            version_ids = [None] * len(policy_ids)
+        keys = [
+            -version if version else (policy or 0)
+            for policy, version in zip(policy_ids, version_ids)
+        ]
+        windows = cls.get_return_windows(
+            reason, [v for v in version_ids if v]
+        )
+
+        if numpy is not None:
+            return cls._get_eligibility_numpy(
+                windows, keys, sale_dates, shipping_dates, date
+            )
+
+        index = dict((k, i) for i, k in enumerate(windows[0]))
+        eligible, deadlines = [], []
+        for key, sale_date, shipping_date in zip(
+                keys, sale_dates, shipping_dates):
+            deadline = None
+            i = index.get(key)
+            if i is not None:
+                for days, since_date in [
+                        (windows[1][i], sale_date),
+                        (windows[2][i], shipping_date)]:
+                    if days < 0 or since_date is None:
+                        continue
+                    since_deadline = since_date + datetime.timedelta(days)
+                    deadline = max(deadline, since_deadline) \
+                        if deadline else since_deadline
+            deadlines.append(deadline)
+            eligible.append(deadline is not None and deadline >= date)
+        return eligible, deadlines
+
+    @staticmethod
+    def _get_eligibility_numpy(
+            windows, keys, sale_dates, shipping_dates, date):
+        policies = numpy.array(windows[0], dtype=numpy.int64)
+        sale_days = numpy.array(windows[1], dtype=numpy.int64)
+        shipping_days = numpy.array(windows[2], dtype=numpy.int64)
+
+        ids = numpy.array(keys, dtype=numpy.int64)
+        sale_dates = numpy.array(sale_dates, dtype='datetime64[D]')
+        shipping_dates = numpy.array(shipping_dates, dtype='datetime64[D]')
+        not_a_time = numpy.datetime64('NaT')
+
+        if len(policies):
+            index = numpy.clip(
+                numpy.searchsorted(policies, ids), 0, len(policies) - 1
+            )
+            found = policies[index] == ids
+        else:
+            index = numpy.zeros(len(ids), dtype=numpy.int64)
+            found = numpy.zeros(len(ids), dtype=bool)
+            sale_days = shipping_days = numpy.array([-1], dtype=numpy.int64)
+
+        deadlines = []
+        for days, since_dates in [
+                (sale_days[index], sale_dates),
+                (shipping_days[index], shipping_dates)]:
+            deadlines.append(numpy.where(
+                found & (days >= 0),
+                since_dates + days.astype('timedelta64[D]'),
+                not_a_time
+            ))
+        sale_deadline, shipping_deadline = deadlines
+        deadline = numpy.where(
+            numpy.isnat(sale_deadline), shipping_deadline,
+            numpy.where(
+                numpy.isnat(shipping_deadline), sale_deadline,
+                numpy.maximum(sale_deadline, shipping_deadline)
+            )
+        )
+        eligible = ~numpy.isnat(deadline) & (
+            deadline >= numpy.datetime64(date, 'D')
+        )
+        return eligible.tolist(), deadline.astype(object).tolist()
+
+    @classmethod
+    def get_term_predicates(cls, policy_ids):
+        """
+        Returns for each policy a dictionary of the compiled predicates of
+        its terms by reason. A predicate takes the ReturnLineFacts of a line
+        and returns True if the line fulfills the rules of the term.
+
+        The predicates are compiled once per policy and cached until a
+        policy, a term or a rule is modified.
+        """
+        pool = Pool()
+        ReturnPolicyTerm = pool.get('sale.return.policy.term')
+        ReturnPolicyTermRule = pool.get('sale.return.policy.term.rule')
+
+        result = {}
+        missing = []
+        for policy_id in set(policy_ids):
+            predicates = cls._predicates_cache.get(policy_id)
+            if predicates is None:
+                missing.append(policy_id)
+            else:
+                result[policy_id] = predicates
+        if not missing:
+            return result
+
+        terms = ReturnPolicyTerm.search([
+            ('policy', 'in', missing),
+        ])
+        rules_by_term = {}
+        for rule in ReturnPolicyTermRule.search([
+                    ('term', 'in', map(int, terms)),
+                ]):
+            rules_by_term.setdefault(rule.term.id, []).append(rule.compile())
+
+        for policy_id in missing:
+            result[policy_id] = {}
+        for term in terms:
+            result[term.policy.id].setdefault(
+                term.reason and term.reason.id, []
+            ).append(ReturnPolicyTermRule.combine(
+                rules_by_term.get(term.id, [])
+            ))
+        for policy_id in missing:
+            cls._predicates_cache.set(policy_id, result[policy_id])
+        return result
+
+
+class ReturnPolicyVersion(ModelSQL, ModelView):
+    """
+    Sale Return Policy Version
+
+    An immutable snapshot of the terms of a policy, created each time they
+    change. As a version never changes, its terms are cached for the life
+    of the process without any invalidation.
+    """
+    __name__ = 'sale.return.policy.version'
+
+    policy = fields.Many2One(
+        'sale.return.policy', 'Policy', required=True, readonly=True,
+        select=True, ondelete='CASCADE'
+    )
+    number = fields.Integer('Number', required=True, readonly=True)
+    snapshot = fields.Text('Snapshot', required=True, readonly=True)
+
+    # Terms and compiled predicates by snapshot, shared by all the
+    # transactions and databases as a snapshot always gives the same terms
+    _terms_cache = LRUDict(1024)
+    _predicates_cache = LRUDict(1024)
+
+    @classmethod
+    def __setup__(cls):
+        super(ReturnPolicyVersion, cls).__setup__()
+        cls._order.insert(0, ('number', 'DESC'))
+        cls._sql_constraints += [
+            ('policy_number_uniq', 'UNIQUE(policy, number)',
+                'The version number must be unique per policy.'),
+        ]
+        cls._error_messages.update({
+            'immutable': 'Return policy versions can not be modified.',
+        })
+
+    def get_rec_name(self, name):
+        return '%s (%s)' % (self.policy.rec_name, self.number)
+
+    @classmethod
+    def write(cls, *args):
+        cls.raise_user_error('immutable')
+
+    @classmethod
+    def get_current_versions(cls, policies):
+        """
+        Returns the version in force of each policy, the first version of
+        the policies which have none yet (like those created before the
+        versioning) is created from their current terms
+        """
+        ReturnPolicy = Pool().get('sale.return.policy')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        policy_ids = map(int, policies)
+        version_ids = []
+        for i in range(0, len(policy_ids), cursor.IN_MAX):
+            sub_ids = policy_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*table.select(
+                Max(table.id),
+                where=SqlIn(table.policy, sub_ids),
+                group_by=table.policy
+            ))
+            version_ids.extend(r[0] for r in cursor.fetchall())
+        versions = dict((v.policy.id, v) for v in cls.browse(version_ids))
+
+        missing = [p for p in policy_ids if p not in versions]
+        if missing:
+            versions.update((v.policy.id, v) for v in cls.create([{
+                'policy': policy.id,
+                'number': 1,
+                'snapshot': policy.get_snapshot(),
+            } for policy in ReturnPolicy.browse(missing)]))
+        return versions
+
+    @classmethod
+    def _get_snapshots(cls, version_ids):
+        """
+        Returns the snapshot of each version, read with one query per IN_MAX
+        versions
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        version_ids = list(set(version_ids))
+        result = {}
+        for i in range(0, len(version_ids), cursor.IN_MAX):
+            sub_ids = version_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*table.select(
+                table.id, table.snapshot,
+                where=reduce_ids(table.id, sub_ids)
+            ))
+            result.update(cursor.fetchall())
+        return result
+
+    @classmethod
+    def _parse_snapshot(cls, snapshot):
+        """
+        Returns the tuple of VersionTerm of the snapshot
+        """
+        terms = cls._terms_cache.get(snapshot)
+        if terms is None:
+            terms = cls._terms_cache[snapshot] = tuple(
+                VersionTerm(reason, days, since, paid, tuple(
+                    tuple(rule) for rule in rules
+                ))
+                for reason, days, since, paid, rules in json.loads(snapshot)
+            )
+        return terms
+
+    @classmethod
+    def get_terms(cls, version_ids):
+        """
+        Returns the tuple of VersionTerm of each version.
+
+        The snapshots are only parsed when they are not in the cache. The
+        cache is keyed by the snapshot and not by the id, which may be
+        reused after a rollback.
+        """
+        return dict(
+            (version_id, cls._parse_snapshot(snapshot))
+            for version_id, snapshot
+            in cls._get_snapshots(version_ids).iteritems()
+        )
+
+    @classmethod
+    def get_origin_terms(cls, origins):
+        """
+        Returns the (reason, days, since) terms applying to each ReturnOrigin
+        by id, those of its version or the current terms of its policy when
+        it has no version
+        """
+        ReturnPolicy = Pool().get('sale.return.policy')
+
+        version_terms = cls.get_terms(
+            [o.version for o in origins if o.version]
+        )
+        tables = ReturnPolicy.get_tables()
+
+        result = {}
+        for origin in origins:
+            if origin.version:
+                terms = version_terms[origin.version]
+            else:
+                terms = [
+                    tables['terms'][t]
+                    for t in tables['policy_terms'].get(origin.policy, ())
+                ]
+            result[origin.id] = [(t.reason, t.days, t.since) for t in terms]
+        return result
+
+    @classmethod
+    def get_term_predicates(cls, version_ids):
+        """
+        Returns for each version a dictionary of the compiled predicates of
+        its terms by reason, like ReturnPolicy.get_term_predicates but from
+        the rules of the version. They are compiled once per snapshot.
+        """
+        ReturnPolicyTermRule = Pool().get('sale.return.policy.term.rule')
+
+        result = {}
+        for version_id, snapshot in cls._get_snapshots(
+                version_ids).iteritems():
+            predicates = cls._predicates_cache.get(snapshot)
+            if predicates is None:
+                predicates = {}
+                for term in cls._parse_snapshot(snapshot):
+                    predicates.setdefault(term.reason, []).append(
+                        ReturnPolicyTermRule.combine([
+                            ReturnPolicyTermRule.compile_snapshot(rule)
+                            for rule in term.rules
+                        ])
+                    )
+                cls._predicates_cache[snapshot] = predicates
+            result[version_id] = predicates
+        return result
 
 
 class ReturnPolicyTerm(ModelSQL, ModelView):
@@ -35,6 +555,248 @@ class ReturnPolicyTerm(ModelSQL, ModelView):
         ('sale', 'Sale'),
     ], 'Days Since', required=True)
     shipping_paid_by_customer = fields.Boolean('Shipping Paid by Customer?')
+    rules = fields.One2Many(
+        'sale.return.policy.term.rule', 'term', 'Rules',
+        help='Conditions the return lines must all fulfill'
+    )
+
+    @classmethod
+    def __post_setup__(cls):
+        super(ReturnPolicyTerm, cls).__post_setup__()
+
+        # Warm the caches of the return tables when the pool of an
+        # installed database is initialised
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        if cursor is None:
+            return
+        pool = Pool()
+        ReturnPolicy = pool.get('sale.return.policy')
+        ReturnReason = pool.get('sale.return.reason')
+        if all(
+                TableHandler.table_exist(cursor, Model._table)
+                for Model in [ReturnPolicy, cls, ReturnReason]):
+            ReturnPolicy.warm_cache()
+
+    @classmethod
+    def create(cls, vlist):
+        ReturnPolicy = Pool().get('sale.return.policy')
+
+        terms = super(ReturnPolicyTerm, cls).create(vlist)
+        ReturnPolicy.changed([t.policy for t in terms if t.policy])
+        return terms
+
+    @classmethod
+    def write(cls, *args):
+        ReturnPolicy = Pool().get('sale.return.policy')
+
+        terms = sum(args[::2], [])
+        policies = [t.policy for t in terms if t.policy]
+        super(ReturnPolicyTerm, cls).write(*args)
+        policies += [t.policy for t in cls.browse(terms) if t.policy]
+        ReturnPolicy.changed(policies)
+
+    @classmethod
+    def delete(cls, terms):
+        ReturnPolicy = Pool().get('sale.return.policy')
+
+        policies = [t.policy for t in terms if t.policy]
+        super(ReturnPolicyTerm, cls).delete(terms)
+        ReturnPolicy.changed(policies)
+
+    def get_snapshot(self):
+        """
+        Returns the term and its rules as a list serializable as JSON
+        """
+        return [
+            self.reason and self.reason.id, self.days, self.since,
+            bool(self.shipping_paid_by_customer),
+            sorted(rule.get_snapshot() for rule in self.rules),
+        ]
+
+
+NUMBER_SUBJECTS = ['amount', 'quantity']
+OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+class ReturnPolicyTermRule(ModelSQL, ModelView):
+    """
+    Sale Return Policy Term Rule
+    """
+    __name__ = 'sale.return.policy.term.rule'
+
+    term = fields.Many2One(
+        'sale.return.policy.term', 'Term', required=True, select=True,
+        ondelete='CASCADE'
+    )
+    subject = fields.Selection([
+        ('amount', 'Amount'),
+        ('quantity', 'Quantity'),
+        ('product_category', 'Product Category'),
+        ('party_category', 'Party Category'),
+    ], 'Subject', required=True)
+    operator = fields.Selection([
+        ('=', '='),
+        ('!=', '!='),
+        ('<', '<'),
+        ('<=', '<='),
+        ('>', '>'),
+        ('>=', '>='),
+    ], 'Operator', required=True)
+    number = fields.Numeric(
+        'Number', digits=(16, 2),
+        states={
+            'invisible': ~In(Eval('subject'), NUMBER_SUBJECTS),
+            'required': In(Eval('subject'), NUMBER_SUBJECTS),
+        },
+        depends=['subject']
+    )
+    product_category = fields.Many2One(
+        'product.category', 'Product Category',
+        states={
+            'invisible': Eval('subject') != 'product_category',
+            'required': Eval('subject') == 'product_category',
+        },
+        depends=['subject']
+    )
+    party_category = fields.Many2One(
+        'party.category', 'Party Category',
+        states={
+            'invisible': Eval('subject') != 'party_category',
+            'required': Eval('subject') == 'party_category',
+        },
+        depends=['subject']
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(ReturnPolicyTermRule, cls).__setup__()
+        cls._error_messages.update({
+            'invalid_category_operator':
+                'Only "=" and "!=" operators can be used on categories.',
+        })
+
+    @staticmethod
+    def default_operator():
+        return '='
+
+    @classmethod
+    def validate(cls, rules):
+        super(ReturnPolicyTermRule, cls).validate(rules)
+        for rule in rules:
+            if (rule.subject not in NUMBER_SUBJECTS
+                    and rule.operator not in ('=', '!=')):
+                cls.raise_user_error('invalid_category_operator')
+
+    @classmethod
+    def create(cls, vlist):
+        ReturnPolicy = Pool().get('sale.return.policy')
+
+        rules = super(ReturnPolicyTermRule, cls).create(vlist)
+        ReturnPolicy.changed([r.term.policy for r in rules if r.term.policy])
+        return rules
+
+    @classmethod
+    def write(cls, *args):
+        ReturnPolicy = Pool().get('sale.return.policy')
+
+        rules = sum(args[::2], [])
+        policies = [r.term.policy for r in rules if r.term.policy]
+        super(ReturnPolicyTermRule, cls).write(*args)
+        policies += [
+            r.term.policy for r in cls.browse(rules) if r.term.policy
+        ]
+        ReturnPolicy.changed(policies)
+
+    @classmethod
+    def delete(cls, rules):
+        ReturnPolicy = Pool().get('sale.return.policy')
+
+        policies = [r.term.policy for r in rules if r.term.policy]
+        super(ReturnPolicyTermRule, cls).delete(rules)
+        ReturnPolicy.changed(policies)
+
+    def get_snapshot(self):
+        """
+        Returns the rule as a list serializable as JSON
+        """
+        return [
+            self.subject, self.operator,
+            str(self.number) if self.number is not None else None,
+            self.product_category and self.product_category.id,
+            self.party_category and self.party_category.id,
+        ]
+
+    def compile(self):
+        """
+        Returns the rule as a function of the ReturnLineFacts of a line
+        """
+        return self.compile_snapshot(self.get_snapshot())
+
+    @staticmethod
+    def compile_snapshot(snapshot):
+        """
+        Returns the rule given by its snapshot as a function of the
+        ReturnLineFacts of a line
+        """
+        subject, operator_, number, product_category, party_category = \
+            snapshot
+        compare = OPERATORS[operator_]
+        if subject in NUMBER_SUBJECTS:
+            getter = operator.attrgetter(subject)
+            number = Decimal(number)
+            return lambda facts: compare(getter(facts), number)
+        elif subject == 'product_category':
+            return lambda facts: compare(
+                facts.product_category, product_category
+            )
+        elif subject == 'party_category':
+            member = operator_ == '='
+            return lambda facts: (
+                party_category in facts.party_categories
+            ) == member
+
+    @classmethod
+    def get_line_facts(cls, lines):
+        """
+        Returns the ReturnLineFacts of the return lines, the categories of
+        the parties are read at once
+        """
+        Party = Pool().get('party.party')
+
+        party_ids = list(set(l.sale.party.id for l in lines))
+        party_categories = dict(
+            (p['id'], frozenset(p['categories']))
+            for p in Party.read(party_ids, ['categories'])
+        )
+        return [
+            ReturnLineFacts(
+                amount=abs(l.amount or Decimal('0')),
+                quantity=abs(l.quantity or 0),
+                product_category=(
+                    l.product.category and l.product.category.id
+                ),
+                party_categories=party_categories[l.sale.party.id],
+            ) for l in lines
+        ]
+
+    @staticmethod
+    def combine(predicates):
+        """
+        Returns a predicate which is True if all the predicates are True
+        """
+        if not predicates:
+            return lambda facts: True
+        if len(predicates) == 1:
+            return predicates[0]
+        return lambda facts: all(p(facts) for p in predicates)
 
 
 class ReturnReason(ModelSQL, ModelView):
@@ -45,3 +807,313 @@ class ReturnReason(ModelSQL, ModelView):
 
     name = fields.Char('Name', required=True, select=True)
     description = fields.Text('Description')
+
+    @classmethod
+    def create(cls, vlist):
+        ReturnPolicy = Pool().get('sale.return.policy')
+
+        reasons = super(ReturnReason, cls).create(vlist)
+        ReturnPolicy._tables_cache.clear()
+        return reasons
+
+    @classmethod
+    def write(cls, *args):
+        ReturnPolicy = Pool().get('sale.return.policy')
+
+        super(ReturnReason, cls).write(*args)
+        ReturnPolicy._tables_cache.clear()
+
+    @classmethod
+    def delete(cls, reasons):
+        ReturnPolicy = Pool().get('sale.return.policy')
+
+        super(ReturnReason, cls).delete(reasons)
+        ReturnPolicy._tables_cache.clear()
+
+
+class ReturnHistory(ModelSQL, ModelView):
+    """
+    Sale Return History
+
+    One record per confirmed return sale and return reason, maintained when
+    sales are confirmed and cancelled. It is used to summarize the returns
+    of a party over a window without reading its sales.
+    """
+    __name__ = 'sale.return.history'
+
+    party = fields.Many2One(
+        'party.party', 'Party', required=True, readonly=True, select=True
+    )
+    company = fields.Many2One(
+        'company.company', 'Company', required=True, readonly=True
+    )
+    sale = fields.Many2One(
+        'sale.sale', 'Sale', required=True, readonly=True, select=True,
+        ondelete='CASCADE'
+    )
+    date = fields.Date('Date', required=True, readonly=True)
+    reason = fields.Many2One('sale.return.reason', 'Reason', readonly=True)
+    lines = fields.Integer('Lines', required=True, readonly=True)
+    amount = fields.Numeric('Amount', digits=(16, 2), readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ReturnHistory, cls).__setup__()
+        cls._order.insert(0, ('date', 'DESC'))
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(ReturnHistory, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['party', 'date'], 'remove')
+        table.index_action(['company', 'party', 'date'], 'add')
+
+    @classmethod
+    def _get_history(cls, sale):
+        """
+        Returns the list of history values for a return sale
+        """
+        values = {}
+        for line in sale.lines:
+            if not line.is_return:
+                continue
+            reason = line.return_reason and line.return_reason.id
+            if reason not in values:
+                values[reason] = {
+                    'party': sale.party.id,
+                    'company': sale.company.id,
+                    'sale': sale.id,
+                    'date': sale.sale_date,
+                    'reason': reason,
+                    'lines': 0,
+                    'amount': Decimal('0'),
+                }
+            values[reason]['lines'] += 1
+            values[reason]['amount'] += abs(line.amount or Decimal('0'))
+        return values.values()
+
+    @classmethod
+    def record(cls, sales):
+        """
+        Record the returns of the sales, replacing previous records
+        """
+        cls.forget(sales)
+
+        to_create = []
+        for sale in sales:
+            to_create.extend(cls._get_history(sale))
+        if to_create:
+            cls.create(to_create)
+
+    @classmethod
+    def forget(cls, sales):
+        """
+        Remove the returns of the sales from the history
+        """
+        cls.delete(cls.search([
+            ('sale', 'in', map(int, sales)),
+        ]))
+
+    @classmethod
+    def get_summary(cls, party, days, date=None, company=None):
+        """
+        Returns the returns of the party for the company over the last days
+        as a dictionary with the number of returns, the returned amount and
+        the number of lines by reason.
+
+        It reads only the history of the party within the window, through
+        the (company, party, date) index.
+        """
+        Date = Pool().get('ir.date')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        if date is None:
+            date = Date.today()
+        if company is None:
+            company = Transaction().context.get('company')
+
+        cursor.execute(*table.select(
+            table.sale, table.reason, table.lines, table.amount,
+            where=(table.company == int(company))
+            & (table.party == int(party))
+            & (table.date >= date - datetime.timedelta(days=days))
+            & (table.date <= date)
+        ))
+        sales = set()
+        summary = {
+            'returns': 0,
+            'amount': Decimal('0'),
+            'reasons': {},
+        }
+        for sale, reason, lines, amount in cursor.fetchall():
+            sales.add(sale)
+            summary['amount'] += Decimal(str(amount or 0))
+            summary['reasons'][reason] = \
+                summary['reasons'].get(reason, 0) + lines
+        summary['returns'] = len(sales)
+        return summary
+
+
+class ReturnArchive(ModelSQL, ModelView):
+    """
+    Sale Return Archive
+
+    Return lines of done sales whose origin was sold before the longest
+    window of the return policy terms. They are flagged as archived on the
+    sale line, which drops them from the partial index of the return
+    lookups, and their origin is flagged as having archived returns so
+    that the lookups only read this table for those origins.
+    """
+    __name__ = 'sale.return.archive'
+
+    line = fields.Many2One(
+        'sale.line', 'Line', required=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    origin = fields.Char('Origin', required=True, readonly=True)
+    sale = fields.Many2One('sale.sale', 'Sale', required=True, readonly=True)
+    party = fields.Many2One(
+        'party.party', 'Party', required=True, readonly=True
+    )
+    company = fields.Many2One(
+        'company.company', 'Company', required=True, readonly=True
+    )
+    origin_date = fields.Date('Origin Date', readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(ReturnArchive, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['company', 'origin'], 'add')
+
+    @classmethod
+    def get_archive_date(cls):
+        """
+        Returns the date before which the origins are archived, it is
+        computed from the longest window of the return policy terms
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+        ReturnPolicy = pool.get('sale.return.policy')
+
+        terms = ReturnPolicy.get_tables()['terms'].values()
+        if not terms:
+            return None
+        days = max(t.days for t in terms)
+        return Date.today() - datetime.timedelta(days=days)
+
+    @staticmethod
+    def is_archived(origin):
+        """
+        Returns True if some returns of the origin line are archived
+        """
+        return bool(origin.returns_archived)
+
+    @classmethod
+    def get_archived_lines(cls, origin, party=None):
+        """
+        Returns the ids of the archived return lines of the origin line
+        """
+        domain = [
+            ('company', '=', origin.sale.company.id),
+            ('origin', '=', '%s,%s' % (origin.__name__, origin.id)),
+        ]
+        if party is not None:
+            domain.append(('party', '=', int(party)))
+        return [a.line.id for a in cls.search(domain)]
+
+    @classmethod
+    def _get_archive(cls, line):
+        """
+        Returns the archive values of the return line
+        """
+        return {
+            'line': line.id,
+            'origin': '%s,%s' % (line.origin.__name__, line.origin.id),
+            'sale': line.sale.id,
+            'party': line.sale.party.id,
+            'company': line.sale.company.id,
+            'origin_date': line.origin.sale.sale_date,
+        }
+
+    @staticmethod
+    def _is_archivable(line, date):
+        """
+        Returns True if the return line can be archived at date
+        """
+        return (
+            line.sale.state == 'done'
+            and line.origin.sale.sale_date is not None
+            and line.origin.sale.sale_date < date
+        )
+
+    @classmethod
+    def archive(cls, date=None, chunk_size=1000):
+        """
+        Archive the return lines of done sales whose origin was sold before
+        date, by chunks of chunk_size lines.
+
+        The scan starts after the checkpoint of the sale configuration. It
+        is then moved before the first return line which may be archived by
+        a later run, so each run only reads the returns which were not
+        settled at the previous one.
+        """
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        Configuration = pool.get('sale.configuration')
+        cursor = Transaction().cursor
+        sale_line = SaleLine.__table__()
+
+        if date is None:
+            date = cls.get_archive_date()
+            if date is None:
+                return
+
+        config = Configuration(1)
+        last_id = config.return_archive_checkpoint or 0
+        checkpoint = None
+        while True:
+            lines = SaleLine.search([
+                ('id', '>', last_id),
+                ('return_archived', '=', False),
+                ('origin', 'like', '%s,%%' % SaleLine.__name__),
+                ('sale.state', '!=', 'cancel'),
+            ], order=[('id', 'ASC')], limit=chunk_size)
+            if not lines:
+                break
+            last_id = lines[-1].id
+
+            lines = [l for l in lines if l.origin]
+            to_archive = [l for l in lines if cls._is_archivable(l, date)]
+            archived = set(map(int, to_archive))
+            pending = [l.id for l in lines if l.id not in archived]
+            if pending and checkpoint is None:
+                checkpoint = pending[0] - 1
+            if not to_archive:
+                continue
+
+            cls.create([cls._get_archive(l) for l in to_archive])
+            for column, ids in [
+                    (sale_line.return_archived, map(int, to_archive)),
+                    (sale_line.returns_archived,
+                        list(set(l.origin.id for l in to_archive)))]:
+                cursor.execute(*sale_line.update(
+                    columns=[column],
+                    values=[True],
+                    where=reduce_ids(sale_line.id, ids)
+                ))
+
+        if checkpoint is None:
+            checkpoint = last_id
+        Configuration.write([config], {
+            'return_archive_checkpoint': checkpoint,
+        })
@@ -4,6 +4,12 @@
 """
 import unittest
 import datetime
+import json
+import os
+import re
+import sqlite3
+import tempfile
+from StringIO import StringIO
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
 
@@ -12,6 +18,18 @@ from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
 from trytond.transaction import Transaction
 from trytond.pyson import Eval
 from trytond.exceptions import UserError
+from trytond.model import Model
+from trytond.cache import Cache
+from trytond import backend
+from trytond.config import config
+from trytond.modules.sale_return.event import FileTarget, SQLiteTarget
+from trytond.modules.sale_return.sale import ReturnOrigin
+from trytond.modules.sale_return.return_audit import AuditLine
+from trytond.modules.sale_return import profiler
+from trytond.modules.sale_return import sale_return
+
+# Default data committed by the first test, as (model name, id) by attribute
+BASELINE = {}
 
 
 class TestSaleReturn(unittest.TestCase):
@@ -142,6 +160,43 @@ class TestSaleReturn(unittest.TestCase):
 
     def setup_defaults(self):
         """Creates default data for testing
+
+        The data is created and committed by the first test only, the next
+        tests browse it again and only their own changes are rolled back.
+        """
+        if BASELINE:
+            self._load_baseline()
+            return
+        self._create_defaults()
+        BASELINE.update(
+            (name, (value.__name__, value.id))
+            for name, value in self.__dict__.iteritems()
+            if isinstance(value, Model) and value.id is not None
+        )
+        Transaction().cursor.commit()
+
+    def _load_baseline(self):
+        """
+        Browses the committed default data in the current transaction and
+        clears the caches which could hold data of a rolled back test
+        """
+        for name, (model_name, record_id) in BASELINE.iteritems():
+            setattr(self, name, POOL.get(model_name)(record_id))
+        CONTEXT.update(self.User.get_preferences(context_only=True))
+        self._clear_caches()
+
+    @staticmethod
+    def _clear_caches():
+        """
+        Clears all the caches, as any of them may hold data of a rolled back
+        test like the policies, their compiled rules or the tables
+        """
+        for cache in Cache._cache_instance:
+            cache.clear()
+
+    def _create_defaults(self):
+        """
+        Creates the default data shared by the tests
         """
         self.country, = self.Country.create([{
             'name': 'United States of America',
@@ -299,6 +354,170 @@ class TestSaleReturn(unittest.TestCase):
         self.sale_configuration.default_return_policy = self.policy_1.id
         self.sale_configuration.save()
 
+    @staticmethod
+    def _get_query_plan(query):
+        """
+        Returns the plan of the query as text without the cost estimates,
+        the sequential scans are disabled on PostgreSQL as the test tables
+        are too small for the planner to prefer the indexes
+        """
+        cursor = Transaction().cursor
+        query, params = tuple(query)
+        if backend.name() == 'postgresql':
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + query, params)
+        else:
+            cursor.execute('EXPLAIN QUERY PLAN ' + query, params)
+        # The estimates depend on the size of the tables, not the plan
+        return '\n'.join(
+            re.sub(r'\s*\(cost=[^)]*\)', '', unicode(r[-1]))
+            for r in cursor.fetchall()
+        )
+
+    def _create_companies(self, count):
+        """
+        Creates count other companies, to populate a multi-company
+        database
+        """
+        companies = []
+        for i in range(count):
+            with Transaction().set_context(company=None):
+                party, = self.Party.create([{
+                    'name': 'Company %s' % i,
+                    'addresses': [('create', [{
+                        'name': 'Company %s' % i,
+                    }])],
+                }])
+            company, = self.Company.create([{
+                'party': party,
+                'currency': self.currency,
+            }])
+            companies.append(company)
+        return companies
+
+    @staticmethod
+    def _set_option(option, value):
+        """
+        Sets the option of the sale_return section of the configuration or
+        removes it if value is None
+        """
+        if not config.has_section('sale_return'):
+            config.add_section('sale_return')
+        if value is None:
+            config.remove_option('sale_return', option)
+        else:
+            config.set('sale_return', option, value)
+
+    def _set_event_target(self, uri):
+        """
+        Sets the event_target option of the configuration or removes it
+        """
+        self._set_option('event_target', uri)
+
+    @staticmethod
+    def _create_replica():
+        """
+        Returns the name of a second local database used as replica of the
+        test database. On SQLite it is a copy of the test database in a
+        temporary directory set as database path. On PostgreSQL it is the
+        test database itself, read on a connection of its own which does
+        not see the uncommitted changes, like a lagging replica.
+        """
+        if backend.name() != 'sqlite':
+            return DB_NAME
+        config.set('database', 'path', tempfile.mkdtemp())
+        replica = sqlite3.connect(os.path.join(
+            config.get('database', 'path'), 'sale_return_replica.sqlite'
+        ))
+        try:
+            replica.executescript(
+                '\n'.join(Transaction().cursor._conn.iterdump())
+            )
+        finally:
+            replica.close()
+        return 'sale_return_replica'
+
+    def _create_customer(self, name):
+        """
+        Creates a customer and returns its sale values, for the tests which
+        commit sales and must not change the sales of the default party.
+        Those tests delete the customer when they end.
+        """
+        party, = self.Party.create([{
+            'name': name,
+            'addresses': [('create', [{
+                'name': name,
+                'city': 'Gotham',
+                'invoice': True,
+                'country': self.country.id,
+            }])],
+            'customer_payment_term': self.payment_term.id,
+            'account_receivable': self._get_account_by_kind('receivable').id,
+        }])
+        return {
+            'party': party.id,
+            'invoice_address': party.addresses[0].id,
+            'shipment_address': party.addresses[0].id,
+        }
+
+    def _delete_customers(self, names):
+        """
+        Deletes the committed customers and all their sales, with their
+        lines, history and events, in a transaction of its own so that the
+        next tests find the baseline only
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            parties = self.Party.search([('name', 'in', names)])
+            sales = self.Sale.search([('party', 'in', map(int, parties))])
+            self.Sale.write(sales, {'state': 'cancel'})
+            self.Sale.delete(sales)
+            self.Party.delete(parties)
+            Transaction().cursor.commit()
+
+    def _create_sale(self, **values):
+        """
+        Creates a draft sale for the default party
+        """
+        Date = POOL.get('ir.date')
+
+        sale_values = {
+            'reference': 'Test Sale',
+            'payment_term': self.payment_term.id,
+            'currency': self.company.currency.id,
+            'party': self.party.id,
+            'invoice_address': self.party.addresses[0].id,
+            'shipment_address': self.party.addresses[0].id,
+            'sale_date': Date.today(),
+            'company': self.company.id,
+        }
+        sale_values.update(values)
+        sale, = self.Sale.create([sale_values])
+        return sale
+
+    def _create_sale_line(self, sale, quantity, origin=None, **values):
+        """
+        Creates a sale line for the default product through the on_change
+        methods, like the client would do
+        """
+        line_values = {
+            'sale': sale.id,
+            'type': 'line',
+            'quantity': quantity,
+            'product': self.product.id,
+        }
+        line_values.update(self.SaleLine(**line_values).on_change_product())
+        line_values.update(self.SaleLine(**line_values).on_change_quantity())
+        if origin is not None:
+            line_values['origin'] = '%s,%s' % (origin.__name__, origin.id)
+            line_values.update(
+                self.SaleLine(**line_values).on_change_origin()
+            )
+        line_values.update(values)
+
+        sale_line = self.SaleLine(**line_values)
+        sale_line.save()
+        return sale_line
+
     def test_0010_test_product_return_policy(self):
         """
         Test the return policy on products
@@ -533,6 +752,1493 @@ class TestSaleReturn(unittest.TestCase):
                         'returned on Sale #%s.' % return_sale.reference)
                 )
 
+    def test_0040_test_bulk_credit_notes(self):
+        """
+        Test credit notes are created in bulk for credit return lines
+        """
+        Invoice = POOL.get('account.invoice')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale = self._create_sale()
+            sale_line1 = self._create_sale_line(sale, 1)
+            sale_line2 = self._create_sale_line(sale, 1)
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            self.Sale.process([sale])
+
+            return_sales = []
+            for orig_line, return_type in [
+                    (sale_line1, 'credit'), (sale_line2, 'credit')]:
+                return_sale = self._create_sale(reference='Return')
+                self._create_sale_line(
+                    return_sale, -1, origin=orig_line,
+                    return_reason=self.reason_2.id,
+                    return_type=return_type,
+                )
+                return_sales.append(return_sale)
+
+            # An exchange line must not be credited
+            exchange_sale = self._create_sale(reference='Exchange')
+            self._create_sale_line(
+                exchange_sale, -1, return_type='exchange',
+            )
+            return_sales.append(exchange_sale)
+
+            # A sale invoiced manually must not be credited
+            manual_sale = self._create_sale(
+                reference='Manual', invoice_method='manual'
+            )
+            self._create_sale_line(manual_sale, -1)
+            return_sales.append(manual_sale)
+
+            # A sale with another payment term gets its own credit note
+            payment_term, = self._create_payment_term()
+            other_sale = self._create_sale(
+                reference='Return', payment_term=payment_term.id
+            )
+            self._create_sale_line(other_sale, -1)
+            return_sales.append(other_sale)
+
+            self.Sale.quote(return_sales)
+            self.Sale.confirm(return_sales)
+
+            credit_notes = self.Sale.create_return_credit_notes(
+                return_sales
+            )
+            self.assertEqual(len(credit_notes), 2)
+            credit_note, = [
+                c for c in credit_notes
+                if c.payment_term == self.payment_term
+            ]
+            self.assertEqual(credit_note.type, 'out_credit_note')
+            self.assertEqual(credit_note.party, self.party)
+            self.assertEqual(len(credit_note.lines), 2)
+            other_credit_note, = [
+                c for c in credit_notes if c.payment_term == payment_term
+            ]
+            self.assertEqual(len(other_credit_note.lines), 1)
+
+            # Nothing is left to credit
+            self.assertEqual(
+                self.Sale.create_return_credit_notes(return_sales), []
+            )
+            self.assertEqual(
+                Invoice.search([
+                    ('type', '=', 'out_credit_note'),
+                ], count=True), 2
+            )
+
+    def test_0050_test_bulk_exchange_lines(self):
+        """
+        Test replacement lines are created for exchange return lines
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale = self._create_sale()
+            sale_line = self._create_sale_line(
+                sale, 2, unit_price=Decimal('18000')
+            )
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            self.Sale.process([sale])
+
+            return_sale = self._create_sale(reference='Exchange')
+            exchange_line = self._create_sale_line(
+                return_sale, -1, origin=sale_line,
+                return_reason=self.reason_2.id, return_type='exchange',
+            )
+            # Without origin, the price is computed
+            other_exchange_line = self._create_sale_line(
+                return_sale, -1, return_type='exchange',
+            )
+            credit_line = self._create_sale_line(
+                return_sale, -1, return_type='credit',
+            )
+
+            replacements = self.Sale.create_exchange_lines([return_sale])
+            self.assertEqual(len(replacements), 2)
+            by_return = dict((r.exchange_of, r) for r in replacements)
+            self.assertNotIn(credit_line, by_return)
+
+            replacement = by_return[exchange_line]
+            self.assertEqual(replacement.sale, return_sale)
+            self.assertEqual(replacement.product, self.product)
+            self.assertEqual(replacement.quantity, 1)
+            self.assertEqual(replacement.unit_price, Decimal('18000'))
+            self.assertFalse(replacement.is_return)
+
+            replacement = by_return[other_exchange_line]
+            self.assertEqual(replacement.unit_price, Decimal('20000'))
+
+            # Already exchanged lines are skipped
+            self.assertEqual(
+                self.Sale.create_exchange_lines([return_sale]), []
+            )
+
+    def test_0060_test_return_import(self):
+        """
+        Test import of returns from CSV and JSON Lines
+        """
+        ReturnImport = POOL.get('sale.return.import')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale = self._create_sale()
+            sale_line1 = self._create_sale_line(sale, 2)
+            sale_line2 = self._create_sale_line(sale, 1)
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+
+            csv_file = StringIO(
+                'origin,reason,return_type,quantity\n'
+                '%s,Reason 2,credit,1\n'
+                '%s,Reason 1,exchange,\n'
+                '0,Reason 1,credit,1\n'
+                '%s,Unknown,credit,1\n'
+                '%s,Reason 1,swap,1\n' % (
+                    sale_line1.id, sale_line2.id, sale_line1.id,
+                    sale_line1.id,
+                )
+            )
+            rows = list(enumerate(
+                ReturnImport._read_rows(csv_file, 'csv'), 1
+            ))
+            self.assertEqual(len(rows), 5)
+
+            sales, _, _, errors = ReturnImport._import_chunk(rows)
+            self.assertEqual([n for n, message in errors], [3, 4, 5])
+
+            return_sale, = sales
+            self.assertTrue(return_sale.has_return)
+            self.assertEqual(return_sale.party, sale.party)
+            line1, line2 = sorted(
+                return_sale.lines, key=lambda l: l.origin.id
+            )
+            self.assertEqual(line1.origin, sale_line1)
+            self.assertEqual(line1.quantity, -1)
+            self.assertEqual(line1.return_reason, self.reason_2)
+            self.assertEqual(line2.origin, sale_line2)
+            self.assertEqual(line2.quantity, -1)
+            self.assertEqual(line2.return_type, 'exchange')
+
+            jsonl_file = StringIO(
+                '{"origin": %s, "reason": "Reason 2"}\n\n' % sale_line1.id
+            )
+            rows = list(enumerate(
+                ReturnImport._read_rows(jsonl_file, 'jsonl'), 1
+            ))
+            sales, _, _, errors = ReturnImport._import_chunk(rows)
+            self.assertFalse(errors)
+            self.assertEqual(sales[0].lines[0].quantity, -2)
+            self.assertEqual(sales[0].lines[0].return_type, 'credit')
+
+    def test_0070_test_return_import_rma_reference(self):
+        """
+        Test returns already imported are skipped or updated
+        """
+        ReturnImport = POOL.get('sale.return.import')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale = self._create_sale()
+            sale_line = self._create_sale_line(sale, 2)
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+
+            rows = list(enumerate([{
+                'origin': sale_line.id, 'reason': 'Reason 2',
+                'rma_channel': 'amazon', 'rma_reference': 'RMA-1',
+            }, {
+                'origin': sale_line.id, 'reason': 'Reason 2',
+                'rma_channel': 'amazon', 'rma_reference': 'RMA-1',
+            }, {
+                'origin': sale_line.id, 'reason': 'Reason 2',
+                'rma_channel': 'ebay', 'rma_reference': 'RMA-1',
+            }], 1))
+            sales, updated, skipped, errors = \
+                ReturnImport._import_chunk(rows)
+            self.assertEqual(len(sales[0].lines), 2)
+            self.assertEqual(skipped, [2])
+            self.assertFalse(updated)
+            self.assertFalse(errors)
+
+            lines = self.SaleLine.get_lines_by_rma_reference([
+                ('amazon', 'RMA-1'), ('ebay', 'RMA-1'), ('ebay', 'RMA-2'),
+            ])
+            self.assertEqual(
+                sorted(lines.keys()),
+                [('amazon', 'RMA-1'), ('ebay', 'RMA-1')]
+            )
+
+            # Re-delivered rows are skipped
+            sales, updated, skipped, errors = \
+                ReturnImport._import_chunk(rows[:1])
+            self.assertEqual((sales, updated, skipped), ([], [], [1]))
+
+            # Or update the existing line
+            rows[0][1]['quantity'] = 1
+            rows[0][1]['return_type'] = 'refund'
+            sales, updated, skipped, errors = \
+                ReturnImport._import_chunk(rows[:1], update_existing=True)
+            self.assertFalse(sales)
+            line, = updated
+            self.assertEqual(line, lines[('amazon', 'RMA-1')])
+            line = self.SaleLine(line.id)
+            self.assertEqual(line.quantity, -1)
+            self.assertEqual(line.return_type, 'refund')
+
+            # The reference is unique per channel
+            self.assertRaises(
+                Exception, self.SaleLine.copy, [line],
+                {'rma_reference': 'RMA-1'}
+            )
+
+            # A reference without channel gets the default channel
+            rows = list(enumerate([{
+                'origin': sale_line.id, 'reason': 'Reason 2',
+                'rma_reference': 'RMA-2',
+            }, {
+                'origin': sale_line.id, 'reason': 'Reason 2',
+                'rma_channel': '', 'rma_reference': 'RMA-2',
+            }], 1))
+            sales, updated, skipped, errors = \
+                ReturnImport._import_chunk(rows)
+            line, = sales[0].lines
+            self.assertEqual(
+                (line.rma_channel, line.rma_reference), ('default', 'RMA-2')
+            )
+            self.assertEqual(skipped, [2])
+
+            # A reference requires a channel
+            with self.assertRaises(UserError):
+                self.SaleLine.write([line], {'rma_channel': None})
+
+    def test_0080_test_return_history(self):
+        """
+        Test the return history of the party and the abuse limits
+        """
+        ReturnHistory = POOL.get('sale.return.history')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            summary = ReturnHistory.get_summary(self.party, 30)
+            self.assertEqual(summary['returns'], 0)
+
+            return_sale = self._create_sale(reference='Return')
+            self._create_sale_line(
+                return_sale, -1, return_reason=self.reason_1.id
+            )
+            self._create_sale_line(
+                return_sale, -1, return_reason=self.reason_2.id
+            )
+            self._create_sale_line(
+                return_sale, -1, return_reason=self.reason_2.id
+            )
+            self.Sale.quote([return_sale])
+            self.Sale.confirm([return_sale])
+
+            summary = ReturnHistory.get_summary(self.party, 30)
+            self.assertEqual(summary['returns'], 1)
+            self.assertEqual(summary['amount'], Decimal('60000'))
+            self.assertEqual(summary['reasons'], {
+                self.reason_1.id: 1,
+                self.reason_2.id: 2,
+            })
+
+            # Limit the number of returns
+            self.sale_configuration.return_abuse_window = 30
+            self.sale_configuration.return_abuse_max_returns = 1
+            self.sale_configuration.save()
+
+            return_sale1 = self._create_sale(reference='Return')
+            self._create_sale_line(return_sale1, -1)
+            self.Sale.quote([return_sale1])
+            with self.assertRaises(UserError):
+                self.Sale.confirm([return_sale1])
+
+            # The sales which do not change state keep their history
+            self.Sale.confirm(self.Sale.browse([return_sale]))
+            self.Sale.cancel(self.Sale.browse([return_sale]))
+            summary = ReturnHistory.get_summary(self.party, 30)
+            self.assertEqual(summary['returns'], 1)
+            self.assertEqual(summary['amount'], Decimal('60000'))
+
+            # Cancelled returns are removed from the history
+            ReturnHistory.forget([return_sale])
+            summary = ReturnHistory.get_summary(self.party, 30)
+            self.assertEqual(summary['returns'], 0)
+
+    def test_0090_test_return_archive(self):
+        """
+        Test old returns are archived and still found
+        """
+        Date = POOL.get('ir.date')
+        ReturnArchive = POOL.get('sale.return.archive')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            # Longest window of the terms is 30 days
+            self.assertEqual(
+                ReturnArchive.get_archive_date(),
+                Date.today() - datetime.timedelta(days=30)
+            )
+
+            sale = self._create_sale(
+                sale_date=Date.today() - datetime.timedelta(days=60)
+            )
+            sale_line = self._create_sale_line(sale, 1)
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+
+            return_sale = self._create_sale(reference='Return')
+            return_line = self._create_sale_line(
+                return_sale, -1, origin=sale_line
+            )
+            self.Sale.quote([return_sale])
+            self.Sale.confirm([return_sale])
+            self.Sale.write([return_sale], {'state': 'done'})
+
+            # A recent return is not archived and holds the checkpoint
+            recent_sale = self._create_sale()
+            recent_line = self._create_sale_line(recent_sale, 1)
+            self.Sale.quote([recent_sale])
+            self.Sale.confirm([recent_sale])
+            recent_return_sale = self._create_sale(reference='Return')
+            recent_return_line = self._create_sale_line(
+                recent_return_sale, -1, origin=recent_line
+            )
+
+            self.assertFalse(ReturnArchive.is_archived(sale_line))
+            ReturnArchive.archive()
+
+            return_line = self.SaleLine(return_line.id)
+            self.assertTrue(return_line.return_archived)
+            archive, = ReturnArchive.search([])
+            self.assertEqual(archive.line, return_line)
+            self.assertEqual(archive.origin_date, sale.sale_date)
+            self.assertTrue(
+                ReturnArchive.is_archived(self.SaleLine(sale_line.id))
+            )
+            self.assertFalse(
+                self.SaleLine(recent_return_line.id).return_archived
+            )
+            self.assertEqual(
+                self.SaleConfiguration(1).return_archive_checkpoint,
+                recent_return_line.id - 1
+            )
+
+            # A longer window does not hide the archived returns
+            term = self.policy_1.terms[0]
+            self.ReturnPolicyTerm.write([term], {'days': 365})
+            self.assertTrue(
+                ReturnArchive.is_archived(self.SaleLine(sale_line.id))
+            )
+
+            # Archived returns are still returned and checked
+            sale_line = self.SaleLine(sale_line.id)
+            self.assertEqual(
+                [l.id for l in sale_line.returns], [return_line.id]
+            )
+
+            return_sale1 = self._create_sale(reference='Return')
+            return_line1 = self._create_sale_line(
+                return_sale1, -1, origin=sale_line
+            )
+            self.assertEqual(
+                return_line1.get_lines_with_same_origin(self.party),
+                [return_line.id]
+            )
+            self.Sale.quote([return_sale1])
+            with self.assertRaises(UserError):
+                self.Sale.confirm([return_sale1])
+
+    def test_0100_test_assign_return_policy(self):
+        """
+        Test bulk assignment of return policies
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            self.assertIsNone(self.product.effective_return_policy)
+
+            self.assertEqual(
+                self.ProductCategory.assign_return_policy([
+                    ('id', '=', self.product_category.id),
+                ], self.policy_1), 1
+            )
+            self.assertEqual(
+                self.ProductTemplate(
+                    self.product_template.id).effective_return_policy,
+                self.policy_1
+            )
+
+            self.ProductTemplate.assign_return_policy([
+                ('category', '=', self.product_category.id),
+            ], self.policy_2)
+            template = self.ProductTemplate(self.product_template.id)
+            self.assertEqual(template.return_policy, self.policy_2)
+            self.assertEqual(template.effective_return_policy, self.policy_2)
+
+            # Clear the policy
+            self.ProductTemplate.assign_return_policy([], None)
+            template = self.ProductTemplate(self.product_template.id)
+            self.assertIsNone(template.return_policy)
+            self.assertEqual(template.effective_return_policy, self.policy_1)
+
+    def test_0110_test_partition_returns(self):
+        """
+        Test the partitions of the parallel confirmation keep the sales of
+        a party together
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            party2, party3 = self.Party.create([{
+                'name': 'Alfred',
+            }, {
+                'name': 'Dick Grayson',
+            }])
+            sales = []
+            for party, count in [
+                    (self.party, 3), (party2, 2), (party3, 1)]:
+                for _ in range(count):
+                    sales.append(self._create_sale(party=party.id))
+
+            partitions = self.Sale._partition_returns(sales, 2)
+            self.assertEqual(len(partitions), 2)
+            self.assertEqual(
+                sorted(sum(partitions, [])), sorted(s.id for s in sales)
+            )
+            for partition in partitions:
+                parties = set(self.Sale(i).party for i in partition)
+                for party in parties:
+                    self.assertEqual(
+                        len([s for s in sales if s.party == party]),
+                        len([
+                            i for i in partition
+                            if self.Sale(i).party == party
+                        ])
+                    )
+            self.assertEqual(sorted(map(len, partitions)), [3, 3])
+
+            # No empty partition
+            self.assertEqual(
+                len(self.Sale._partition_returns(sales, 10)), 3
+            )
+
+    def test_0120_test_return_policy_rules(self):
+        """
+        Test the rules of the return policy terms
+        """
+        ReturnPolicyTermRule = POOL.get('sale.return.policy.term.rule')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            term, = [
+                t for t in self.policy_1.terms if t.reason == self.reason_2
+            ]
+            rule, = ReturnPolicyTermRule.create([{
+                'term': term.id,
+                'subject': 'amount',
+                'operator': '<=',
+                'number': Decimal('10000'),
+            }])
+
+            predicates = self.ReturnPolicy.get_term_predicates(
+                [self.policy_1.id]
+            )
+            self.assertEqual(
+                sorted(predicates[self.policy_1.id].keys()),
+                sorted([self.reason_1.id, self.reason_2.id])
+            )
+
+            return_sale = self._create_sale(reference='Return')
+            self._create_sale_line(
+                return_sale, -1, return_policy=self.policy_1.id,
+                return_reason=self.reason_2.id,
+            )
+            self.Sale.quote([return_sale])
+            with self.assertRaises(UserError):
+                self.Sale.check_return_rules([return_sale])
+
+            # The cache is invalidated when the rule is modified
+            rule.number = Decimal('20000')
+            rule.save()
+            self.Sale.check_return_rules([return_sale])
+
+            # Category rules
+            with self.assertRaises(UserError):
+                ReturnPolicyTermRule.create([{
+                    'term': term.id,
+                    'subject': 'product_category',
+                    'operator': '<',
+                    'product_category': self.product_category.id,
+                }])
+            ReturnPolicyTermRule.create([{
+                'term': term.id,
+                'subject': 'product_category',
+                'operator': '!=',
+                'product_category': self.product_category.id,
+            }])
+            with self.assertRaises(UserError):
+                self.Sale.check_return_rules([return_sale])
+
+    def test_0130_test_return_policy_versions(self):
+        """
+        Test a new policy version is created when its terms change
+        """
+        Version = POOL.get('sale.return.policy.version')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            version1, = self.policy_1.versions
+            self.assertEqual(version1.number, 1)
+            terms = Version.get_terms([version1.id])[version1.id]
+            self.assertEqual(
+                sorted((t.reason, t.days, t.since) for t in terms),
+                sorted([
+                    (self.reason_1.id, 7, 'sale'),
+                    (self.reason_2.id, 30, 'shipping'),
+                ])
+            )
+
+            # Changing the name does not create a version
+            self.policy_1.name = 'Renamed Policy'
+            self.policy_1.save()
+            self.assertEqual(len(self.ReturnPolicy(
+                self.policy_1.id).versions), 1)
+
+            sale = self._create_sale()
+            sale_line = self._create_sale_line(
+                sale, 1, return_policy_at_sale=self.policy_1.id
+            )
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            sale_line = self.SaleLine(sale_line.id)
+            self.assertEqual(sale_line.return_policy_version, version1)
+
+            term = self.policy_1.terms[0]
+            term.days = 90
+            term.save()
+            current = Version.get_current_versions([self.policy_1])
+            version2 = current[self.policy_1.id]
+            self.assertEqual(version2.number, 2)
+
+            # The line keeps the version in force at sale time
+            sale_line = self.SaleLine(sale_line.id)
+            self.assertEqual(sale_line.return_policy_version, version1)
+            terms = Version.get_terms([version1.id])[version1.id]
+            self.assertNotIn(90, [t.days for t in terms])
+
+            # The returns of the line are checked against the rules of its
+            # version, not against those added to the policy since
+            ReturnPolicyTermRule = POOL.get('sale.return.policy.term.rule')
+            term, = [
+                t for t in self.ReturnPolicy(self.policy_1.id).terms
+                if t.reason == self.reason_1
+            ]
+            ReturnPolicyTermRule.create([{
+                'term': term.id,
+                'subject': 'amount',
+                'operator': '<=',
+                'number': Decimal('1'),
+            }])
+            return_sale = self._create_sale(reference='Return')
+            return_line = self._create_sale_line(
+                return_sale, -1, origin=sale_line,
+                return_reason=self.reason_1.id,
+            )
+            self.assertEqual(return_line.return_policy, self.policy_1)
+            self.Sale.check_return_rules([return_sale])
+            return_sale = self._create_sale(reference='Return')
+            self._create_sale_line(
+                return_sale, -1, return_policy=self.policy_1.id,
+                return_reason=self.reason_1.id,
+            )
+            with self.assertRaises(UserError):
+                self.Sale.check_return_rules([return_sale])
+            predicates = Version.get_term_predicates([version1.id])
+            self.assertEqual(
+                sorted(predicates[version1.id].keys()),
+                sorted([self.reason_1.id, self.reason_2.id])
+            )
+
+            with self.assertRaises(UserError):
+                Version.write([version1], {'number': 3})
+
+            # A policy without version gets its first one when needed
+            Version.delete(list(self.policy_2.versions))
+            current = Version.get_current_versions([self.policy_2.id])
+            version, = self.ReturnPolicy(self.policy_2.id).versions
+            self.assertEqual(current[self.policy_2.id], version)
+            self.assertEqual(version.number, 1)
+            self.assertEqual(version.snapshot, self.policy_2.get_snapshot())
+
+            # The numbers are unique per policy
+            self.assertRaises(Exception, Version.create, [{
+                'policy': self.policy_2.id,
+                'number': 1,
+                'snapshot': version.snapshot,
+            }])
+
+    def test_0140_test_return_tables_cache(self):
+        """
+        Test the in-memory copies of the return tables
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            # Warmed like at pool initialisation, used by the requests
+            self.ReturnPolicy._tables_cache.clear()
+            with Transaction().set_user(0), \
+                    Transaction().reset_context():
+                self.ReturnPolicy.warm_cache()
+            with Transaction().set_context(language='fr_FR'):
+                tables = self.ReturnPolicy._tables_cache.get('tables')
+            self.assertIsNotNone(tables)
+            self.assertEqual(
+                tables['policies'][self.policy_2.id], 'Some other Policy'
+            )
+            self.assertEqual(tables['reasons'][self.reason_3.id], 'Reason 3')
+            term_ids = tables['policy_terms'][self.policy_1.id]
+            self.assertEqual(len(term_ids), 2)
+            self.assertEqual(
+                sorted(tables['terms'][i].days for i in term_ids), [7, 30]
+            )
+
+            # Writing any of the tables invalidates the cache
+            self.reason_3.name = 'Damaged'
+            self.reason_3.save()
+            tables = self.ReturnPolicy.get_tables()
+            self.assertEqual(tables['reasons'][self.reason_3.id], 'Damaged')
+
+            self.ReturnPolicyTerm.write(
+                list(self.policy_2.terms), {'days': 60}
+            )
+            tables = self.ReturnPolicy.get_tables()
+            self.assertEqual(
+                set(
+                    tables['terms'][i].days
+                    for i in tables['policy_terms'][self.policy_2.id]
+                ), set([60])
+            )
+
+    def test_0150_test_return_eligibility(self):
+        """
+        Test the bulk return eligibility with and without numpy
+        """
+        original = sale_return.numpy
+        try:
+            for numpy in set([original, None]):
+                sale_return.numpy = numpy
+                self._check_return_eligibility()
+        finally:
+            sale_return.numpy = original
+
+    def _check_return_eligibility(self):
+        """
+        Check the bulk return eligibility
+        """
+        Version = POOL.get('sale.return.policy.version')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            today = datetime.date(2015, 1, 31)
+            days = datetime.timedelta
+
+            windows = self.ReturnPolicy.get_return_windows(self.reason_2.id)
+            self.assertEqual(windows, ((self.policy_1.id,), (-1,), (30,)))
+
+            eligible, deadlines = self.ReturnPolicy.get_eligibility(
+                [self.policy_1.id, self.policy_1.id, self.policy_1.id,
+                    self.policy_2.id, None],
+                self.reason_2.id,
+                [today - days(40), today - days(40), today, today, today],
+                [today - days(10), today - days(31), None, today, today],
+                date=today
+            )
+            self.assertEqual(eligible, [True, False, False, False, False])
+            self.assertEqual(deadlines, [
+                today + days(20), today - days(1), None, None, None,
+            ])
+
+            # The longest term applies
+            version1, = self.policy_1.versions
+            self.ReturnPolicyTerm.create([{
+                'policy': self.policy_1.id,
+                'reason': self.reason_2.id,
+                'days': 60,
+                'since': 'sale',
+            }])
+            eligible, deadlines = self.ReturnPolicy.get_eligibility(
+                [self.policy_1.id], self.reason_2.id,
+                [today - days(40)], [today - days(31)], date=today
+            )
+            self.assertEqual(eligible, [True])
+            self.assertEqual(deadlines, [today + days(20)])
+
+            # The terms of the version of a line apply as on sale.line
+            origins = [
+                ReturnOrigin(
+                    1, self.policy_1.id, version1.id,
+                    today - days(40), today - days(31)
+                ),
+                ReturnOrigin(
+                    2, self.policy_1.id, None,
+                    today - days(40), today - days(31)
+                ),
+            ]
+            eligible, deadlines = self.ReturnPolicy.get_eligibility(
+                [o.policy for o in origins], self.reason_2.id,
+                [o.sale_date for o in origins],
+                [o.shipping_date for o in origins],
+                date=today, version_ids=[o.version for o in origins]
+            )
+            self.assertEqual(eligible, [False, True])
+            self.assertEqual(deadlines, [today - days(1), today + days(20)])
+            line_deadlines = self.SaleLine.get_return_deadlines(origins)
+            self.assertEqual(deadlines, [
+                line_deadlines[o.id][self.reason_2.id] for o in origins
+            ])
+            self.assertEqual(len(Version.search([
+                ('policy', '=', self.policy_1.id),
+            ])), 2)
+
+    def test_0160_test_is_return_getter(self):
+        """
+        Test is_return is computed for many lines at once
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            service_template, = self.ProductTemplate.create([{
+                'name': 'Service',
+                'type': 'service',
+                'salable': True,
+                'category': self.product_category.id,
+                'default_uom': self.uom.id,
+                'sale_uom': self.uom.id,
+                'list_price': Decimal('10'),
+                'cost_price': Decimal('5'),
+                'account_category': True,
+                'products': [('create', [{}])],
+            }])
+            service, = service_template.products
+
+            sale = self._create_sale()
+            lines = [
+                self._create_sale_line(sale, 1),
+                self._create_sale_line(sale, -1),
+                self._create_sale_line(sale, -1, product=service.id),
+            ]
+            comment, = self.SaleLine.create([{
+                'sale': sale.id,
+                'type': 'comment',
+                'description': 'Comment',
+            }])
+            lines.append(comment)
+
+            self.assertEqual(
+                self.SaleLine.get_is_return(lines, 'is_return'), {
+                    lines[0].id: False,
+                    lines[1].id: True,
+                    lines[2].id: False,
+                    comment.id: False,
+                }
+            )
+            self.assertEqual(
+                [l.is_return for l in self.SaleLine.browse(lines)],
+                [False, True, False, False]
+            )
+
+    def test_0170_test_global_duplicate_origin(self):
+        """
+        Test the duplicate origin check across the parties of the company
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            party2, = self.Party.create([{
+                'name': 'Selina Kyle',
+                'addresses': [('create', [{
+                    'name': 'Selina Kyle',
+                    'city': 'Gotham',
+                }])],
+            }])
+
+            sale = self._create_sale()
+            sale_line = self._create_sale_line(sale, 1)
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+
+            return_sale = self._create_sale(reference='Return')
+            return_line = self._create_sale_line(
+                return_sale, -1, origin=sale_line
+            )
+            self.Sale.quote([return_sale])
+            self.Sale.confirm([return_sale])
+
+            # The same line returned by another party
+            return_sale1 = self._create_sale(
+                reference='Return', party=party2.id,
+                invoice_address=party2.addresses[0].id,
+                shipment_address=party2.addresses[0].id,
+            )
+            return_line1 = self._create_sale_line(
+                return_sale1, -1, origin=sale_line
+            )
+            self.assertEqual(
+                return_line1.get_lines_with_same_origin(party2), []
+            )
+            self.assertEqual(
+                return_line1.get_lines_with_same_origin(), [return_line.id]
+            )
+
+            # The sales are only joined to filter on the party
+            query, _ = tuple(return_line1._get_same_origin_query())
+            self.assertNotIn('sale_sale', query)
+            query, _ = tuple(return_line1._get_same_origin_query(party2))
+            self.assertIn('sale_sale', query)
+
+            self.sale_configuration.return_duplicate_scope = 'company'
+            self.sale_configuration.save()
+            self.Sale.quote([return_sale1])
+            with self.assertRaises(UserError):
+                self.Sale.confirm([return_sale1])
+
+    def test_0180_test_multi_company_returns(self):
+        """
+        Test the return lookups are scoped to the company of the line
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale = self._create_sale()
+            sale_line = self._create_sale_line(sale, 1)
+            self.assertEqual(sale_line.company, self.company)
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+
+            return_sale = self._create_sale(reference='Return')
+            return_line = self._create_sale_line(
+                return_sale, -1, origin=sale_line
+            )
+            self.assertEqual(return_line.company, self.company)
+            plan = self._get_query_plan(
+                return_line._get_same_origin_query()
+            )
+            self.assertIn('company_origin_return_index', plan)
+
+            # Lines of many other companies pointing to the same origin
+            origin = '%s,%s' % (self.SaleLine.__name__, sale_line.id)
+            for company in self._create_companies(10):
+                with Transaction().set_context(company=company.id):
+                    other_sale = self._create_sale(
+                        company=company.id,
+                        invoice_address=company.party.addresses[0].id,
+                        shipment_address=company.party.addresses[0].id,
+                    )
+                    other_line, = self.SaleLine.create([{
+                        'sale': other_sale.id,
+                        'type': 'line',
+                        'product': self.product.id,
+                        'description': 'Bat Mobile',
+                        'quantity': -1,
+                        'unit': self.uom.id,
+                        'unit_price': Decimal('20000'),
+                        'origin': origin,
+                    }])
+                self.assertEqual(other_line.company, company)
+
+            sale_line = self.SaleLine(sale_line.id)
+            self.assertEqual(
+                [l.id for l in sale_line.returns], [return_line.id]
+            )
+            return_sale1 = self._create_sale(reference='Return')
+            return_line1 = self._create_sale_line(
+                return_sale1, -1, origin=sale_line
+            )
+            self.assertEqual(
+                return_line1.get_lines_with_same_origin(), [return_line.id]
+            )
+
+            # The lookup probes the same index whatever the number of
+            # companies, so its cost only depends on the lines of the company
+            self.assertEqual(
+                self._get_query_plan(return_line._get_same_origin_query()),
+                plan
+            )
+
+    def test_0190_test_reporting_cursor(self):
+        """
+        Test the reporting getters fall back on the primary database when
+        no replica is configured
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale = self._create_sale()
+            sale_line = self._create_sale_line(
+                sale, 1, return_policy_at_sale=None
+            )
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+
+            return_sale = self._create_sale(reference='Return')
+            return_line = self._create_sale_line(
+                return_sale, -1, origin=sale_line
+            )
+
+            self.product_template.return_policy = self.policy_2.id
+            self.product_template.save()
+
+            with Transaction().set_context(sale_return_replica=True):
+                sale_line, = self.SaleLine.browse([sale_line.id])
+                self.assertEqual(
+                    [l.id for l in sale_line.returns], [return_line.id]
+                )
+                self.assertEqual(
+                    sale_line.effective_return_policy_at_sale, self.policy_2
+                )
+                sale, return_sale = self.Sale.browse([sale, return_sale])
+                self.assertFalse(sale.has_return)
+                self.assertTrue(return_sale.has_return)
+
+                # Confirmation validates on the primary database
+                self.Sale.quote([return_sale])
+                self.Sale.confirm([return_sale])
+
+    def test_0195_test_reporting_cursor_replica(self):
+        """
+        Test the reporting getters read the replica when one is configured
+        and fall back on the primary database when it can not be reached
+        """
+        path = config.get('database', 'path')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale = self._create_sale()
+            sale_line = self._create_sale_line(sale, 1)
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+
+            try:
+                self._set_option('replica_database', self._create_replica())
+
+                # The return is not on the replica yet
+                return_sale = self._create_sale(reference='Return')
+                return_line = self._create_sale_line(
+                    return_sale, -1, origin=sale_line
+                )
+                with Transaction().set_context(sale_return_replica=True):
+                    self.assertEqual(
+                        self.SaleLine.get_returns([sale_line], 'returns'),
+                        {sale_line.id: []}
+                    )
+                self.assertEqual(
+                    self.SaleLine.get_returns([sale_line], 'returns'),
+                    {sale_line.id: [return_line.id]}
+                )
+
+                self._set_option(
+                    'replica_database', 'sale_return_unreachable'
+                )
+                with Transaction().set_context(sale_return_replica=True):
+                    self.assertEqual(
+                        self.SaleLine.get_returns([sale_line], 'returns'),
+                        {sale_line.id: [return_line.id]}
+                    )
+            finally:
+                self._set_option('replica_database', None)
+                config.set('database', 'path', path)
+
+    def test_0200_test_return_events(self):
+        """
+        Test the return events are written to the outbox on confirmation
+        and kept pending when the delivery fails
+        """
+        ReturnEvent = POOL.get('sale.return.event')
+
+        class FailingTarget(object):
+            def deliver(self, events):
+                raise IOError('Target unavailable')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale = self._create_sale()
+            sale_line = self._create_sale_line(sale, 1)
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            self.assertFalse(ReturnEvent.search([('sale', '=', sale.id)]))
+
+            return_sale = self._create_sale(reference='Return')
+            return_line = self._create_sale_line(
+                return_sale, -1, origin=sale_line
+            )
+            self.Sale.quote([return_sale])
+            self.Sale.confirm([return_sale])
+
+            event, = ReturnEvent.search([('sale', '=', return_sale.id)])
+            self.assertEqual(event.type, 'confirmed')
+            self.assertEqual(event.state, 'pending')
+            payload = json.loads(event.payload)
+            self.assertEqual(payload['sale'], return_sale.id)
+            self.assertEqual(
+                [l['id'] for l in payload['lines']], [return_line.id]
+            )
+
+            # The sales which do not change state add no event
+            self.Sale.confirm(self.Sale.browse([return_sale]))
+            self.Sale.cancel(self.Sale.browse([return_sale]))
+            event, = ReturnEvent.search([('sale', '=', return_sale.id)])
+            self.assertEqual(event.type, 'confirmed')
+
+            with self.assertRaises(IOError):
+                ReturnEvent.dispatch(FailingTarget())
+            event, = ReturnEvent.browse([event])
+            self.assertEqual(event.state, 'pending')
+
+            fileobj = tempfile.NamedTemporaryFile(suffix='.jsonl')
+            self.assertEqual(
+                ReturnEvent.dispatch(FileTarget(fileobj.name)), 1
+            )
+            delivered, = map(json.loads, open(fileobj.name))
+            self.assertEqual(delivered['id'], event.id)
+            self.assertEqual(delivered['type'], 'confirmed')
+            event, = ReturnEvent.browse([event.id])
+            self.assertEqual(event.state, 'done')
+            self.assertTrue(event.dispatch_date)
+
+            # Delivered events are not delivered again
+            self.assertEqual(
+                ReturnEvent.dispatch(FileTarget(fileobj.name)), 0
+            )
+            self.assertEqual(len(open(fileobj.name).readlines()), 1)
+
+            # The SQLite target ignores the events already inserted
+            database = tempfile.NamedTemporaryFile(suffix='.db')
+            sqlite_target = SQLiteTarget(database.name)
+            sqlite_target.deliver([delivered])
+            sqlite_target.deliver([delivered])
+            connection = sqlite3.connect(database.name)
+            rows = connection.execute(
+                'SELECT id, type FROM return_event').fetchall()
+            connection.close()
+            self.assertEqual(rows, [(event.id, 'confirmed')])
+
+            cancelled_sale = self._create_sale(reference='Return')
+            self._create_sale_line(cancelled_sale, -1, origin=sale_line)
+            self.Sale.cancel([cancelled_sale])
+            event, = ReturnEvent.search([('sale', '=', cancelled_sale.id)])
+            self.assertEqual(event.type, 'cancelled')
+
+    def test_0205_test_return_event_target(self):
+        """
+        Test the delivery target of the return events is configured
+        """
+        ReturnEvent = POOL.get('sale.return.event')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            try:
+                self.assertIsNone(ReturnEvent.get_target())
+
+                self._set_event_target('file:///tmp/returns.jsonl')
+                target = ReturnEvent.get_target()
+                self.assertIsInstance(target, FileTarget)
+                self.assertEqual(target.path, '/tmp/returns.jsonl')
+
+                self._set_event_target('sqlite:/tmp/returns.db')
+                target = ReturnEvent.get_target()
+                self.assertIsInstance(target, SQLiteTarget)
+                self.assertEqual(target.path, '/tmp/returns.db')
+
+                self._set_event_target('kafka://localhost')
+                with self.assertRaises(UserError):
+                    ReturnEvent.get_target()
+            finally:
+                self._set_event_target(None)
+
+    def test_0210_test_return_audit(self):
+        """
+        Test the audit of the returns against their policy
+        """
+        ReturnAudit = POOL.get('sale.return.audit')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            today = datetime.date(2015, 1, 31)
+            days = datetime.timedelta
+
+            lines = [
+                AuditLine(1, 1, 10, self.reason_1.id, today),
+                AuditLine(2, 1, 11, self.reason_1.id, today),
+                AuditLine(3, 1, 10, self.reason_3.id, today),
+                AuditLine(4, 1, 12, self.reason_1.id, today),
+                AuditLine(5, 1, 11, self.reason_2.id, today),
+                AuditLine(6, 1, 10, self.reason_2.id, today),
+            ]
+            origins = {
+                10: ReturnOrigin(
+                    10, self.policy_1.id, None, today - days(7), None
+                ),
+                11: ReturnOrigin(
+                    11, self.policy_1.id, None, today - days(8),
+                    today - days(31)
+                ),
+                12: ReturnOrigin(12, None, None, today, None),
+            }
+            violations = ReturnAudit._check_chunk(lines, origins)
+            self.assertEqual(
+                [(l.id, d, v) for l, _, d, v in violations], [
+                    (2, today - days(1), 'late'),
+                    (3, None, 'reason_not_allowed'),
+                    (4, None, 'no_policy'),
+                    (5, today - days(1), 'late'),
+                    (6, None, 'not_shipped'),
+                ]
+            )
+
+            sale = self._create_sale()
+            sale_line = self._create_sale_line(sale, 1)
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+
+            return_sale = self._create_sale(reference='Return')
+            return_line = self._create_sale_line(
+                return_sale, -1, origin=sale_line,
+                return_reason=self.reason_1.id
+            )
+            self.Sale.quote([return_sale])
+            self.Sale.confirm([return_sale])
+
+            checkpoint = tempfile.NamedTemporaryFile()
+            violation_file = StringIO()
+            result = ReturnAudit.audit(
+                violation_file, chunk_size=1,
+                checkpoint_path=checkpoint.name
+            )
+            self.assertEqual(result['lines'], 1)
+            self.assertEqual(result['compliant'], 1)
+            self.assertEqual(result['checkpoint'], return_line.id)
+            self.assertEqual(len(violation_file.getvalue().splitlines()), 1)
+
+            # Resuming after the checkpoint audits nothing more and does
+            # not write the header again
+            violation_file = StringIO()
+            result = ReturnAudit.audit(
+                violation_file, checkpoint_path=checkpoint.name
+            )
+            self.assertEqual(result['lines'], 1)
+            self.assertEqual(result['compliant'], 1)
+            self.assertEqual(result['checkpoint'], return_line.id)
+            self.assertEqual(violation_file.getvalue(), '')
+
+            # The policy of the product applies when the line has none
+            self.product_template.return_policy = self.policy_2.id
+            self.product_template.save()
+            draft_sale = self._create_sale()
+            draft_line = self._create_sale_line(
+                draft_sale, 1, return_policy_at_sale=None
+            )
+            origin = self.SaleLine.get_return_origins(
+                [draft_line.id]
+            )[draft_line.id]
+            self.assertEqual(origin.policy, self.policy_2.id)
+            self.assertIsNone(origin.version)
+
+    def test_0220_test_profiler(self):
+        """
+        Test the profiling of the entry points enabled by the context
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            profiler.reset()
+            sale = self._create_sale()
+            self._create_sale_line(sale, 1)
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            self.assertFalse(profiler.get_stats())
+
+            sale = self._create_sale()
+            with Transaction().set_context(sale_return_profile=True):
+                self._create_sale_line(sale, 1)
+                self.Sale.quote([sale])
+                self.Sale.confirm([sale])
+
+            stats = profiler.get_stats()
+            self.assertEqual(stats['sale.sale.confirm'][0], 1)
+            self.assertEqual(stats['sale.line.on_change_product'][0], 1)
+            self.assertEqual(
+                stats['sale.sale.validate_sale_for_return'][0], 1
+            )
+            folded = dict(
+                l.rsplit(' ', 1) for l in profiler.get_folded().splitlines()
+            )
+            self.assertIn(
+                'sale.sale.confirm;sale.sale.validate_sale_for_return', folded
+            )
+            self.assertIn('sale.sale.confirm', profiler.get_report())
+
+            # The calls nested in a call which is not sampled are not
+            # sampled either, even if the draw would sample them
+            draws = iter([0.9] + [0.] * 100)
+
+            class Random(object):
+                @staticmethod
+                def random():
+                    return next(draws)
+
+            sale = self._create_sale()
+            self._create_sale_line(sale, 1)
+            self.Sale.quote([sale])
+            profiler.reset()
+            self._set_option('profile', 'True')
+            self._set_option('profile_sample_rate', '0.5')
+            profiler.random, random = Random, profiler.random
+            try:
+                self.Sale.confirm([sale])
+            finally:
+                profiler.random = random
+                self._set_option('profile', None)
+                self._set_option('profile_sample_rate', None)
+            self.assertFalse(profiler.get_stats())
+            profiler.reset()
+
+    def test_0230_test_return_eligibility_rpc(self):
+        """
+        Test the return eligibility of a page of lines
+        """
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            today = Date.today()
+            sale = self._create_sale()
+            sale_line = self._create_sale_line(sale, 1)
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+
+            result = self.SaleLine.get_return_eligibility([sale_line.id])
+            self.assertEqual(result['total'], 1)
+            line, = result['lines']
+            self.assertEqual(line['id'], sale_line.id)
+            self.assertEqual(line['policy'], self.policy_1.id)
+            self.assertTrue(line['eligible'])
+            self.assertEqual(line['deadline'], today + datetime.timedelta(7))
+            self.assertEqual(line['reasons'], sorted([{
+                'reason': self.reason_1.id,
+                'eligible': True,
+                'deadline': today + datetime.timedelta(7),
+            }, {
+                'reason': self.reason_2.id,
+                'eligible': False,
+                'deadline': None,
+            }], key=lambda r: r['reason']))
+
+            result = self.SaleLine.get_return_eligibility(
+                [sale_line.id], date=today + datetime.timedelta(8)
+            )
+            self.assertFalse(result['lines'][0]['eligible'])
+
+            # Only the lines found are counted
+            result = self.SaleLine.get_return_eligibility([sale_line.id, -1])
+            self.assertEqual(result['total'], 1)
+
+            # The lines are given by ids or by party
+            with self.assertRaises(UserError):
+                self.SaleLine.get_return_eligibility()
+
+            # Return lines are not listed for the party
+            return_sale = self._create_sale(reference='Return')
+            self._create_sale_line(return_sale, -1, origin=sale_line)
+            self.Sale.quote([return_sale])
+            self.Sale.confirm([return_sale])
+
+            result = self.SaleLine.get_return_eligibility(
+                party=self.party.id, from_date=today, to_date=today
+            )
+            self.assertEqual(result['total'], 1)
+            self.assertEqual(
+                [l['id'] for l in result['lines']], [sale_line.id]
+            )
+            result = self.SaleLine.get_return_eligibility(
+                party=self.party.id, offset=1
+            )
+            self.assertEqual(result['total'], 1)
+            self.assertEqual(result['lines'], [])
+
+    def test_0240_test_confirm_returns(self):
+        """
+        Test the confirmation of committed sales on a pool of processes
+        """
+        self.addCleanup(self._delete_customers, ['Selina Kyle'])
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale_values = self._create_customer('Selina Kyle')
+            sale = self._create_sale(**sale_values)
+            sale_line = self._create_sale_line(sale, 1)
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+
+            good_sale = self._create_sale(**sale_values)
+            self._create_sale_line(good_sale, 1)
+            # Both lines return the same origin
+            bad_sale = self._create_sale(reference='Return', **sale_values)
+            self._create_sale_line(bad_sale, -1, origin=sale_line)
+            self._create_sale_line(bad_sale, -1, origin=sale_line)
+            self.Sale.quote([good_sale, bad_sale])
+            # A sale which is not in quotation is not confirmed
+            draft_sale = self._create_sale(**sale_values)
+            self._create_sale_line(draft_sale, 1)
+            Transaction().cursor.commit()
+
+            report = self.Sale.confirm_returns(
+                [good_sale, bad_sale, draft_sale], processes=2
+            )
+            self.assertEqual(report['confirmed'], [good_sale.id])
+            failed = dict(report['failed'])
+            self.assertEqual(
+                sorted(failed), sorted([bad_sale.id, draft_sale.id])
+            )
+            self.assertTrue(failed[bad_sale.id])
+            self.assertIn('not in quotation', failed[draft_sale.id])
+
+        if DB_NAME != ':memory:':
+            # The workers committed on the database of the parent
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                good_sale, bad_sale = self.Sale.browse([
+                    good_sale.id, bad_sale.id,
+                ])
+                self.assertEqual(good_sale.state, 'confirmed')
+                self.assertEqual(bad_sale.state, 'quotation')
+
+    def test_0250_test_return_import_file(self):
+        """
+        Test the import of a file commits the valid rows of each chunk and
+        reports the invalid rows
+        """
+        ReturnImport = POOL.get('sale.return.import')
+
+        self.addCleanup(self._delete_customers, ['Harvey Dent'])
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale_values = self._create_customer('Harvey Dent')
+            sale = self._create_sale(**sale_values)
+            sale_line = self._create_sale_line(sale, 2)
+            comment, = self.SaleLine.create([{
+                'sale': sale.id,
+                'type': 'comment',
+                'description': 'Comment',
+            }])
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            return_sale = self._create_sale(**sale_values)
+            return_line = self._create_sale_line(
+                return_sale, -1, origin=sale_line
+            )
+
+            jsonl_file = StringIO('\n'.join([
+                json.dumps({'origin': sale_line.id, 'reason': 'Reason 1'}),
+                '{"origin": ',
+                # Comment and return lines can not be returned
+                json.dumps({'origin': comment.id}),
+                json.dumps({'origin': sale_line.id, 'quantity': 1}),
+                '[1, 2]',
+                json.dumps({'origin': return_line.id}),
+            ]))
+            error_file = StringIO()
+            result = ReturnImport.import_file(
+                jsonl_file, 'jsonl', chunk_size=2, error_file=error_file
+            )
+            self.assertEqual(result, {
+                'rows': 6, 'sales': 2, 'updated': 0, 'skipped': 0,
+                'errors': 4,
+            })
+            error_rows = error_file.getvalue().splitlines()
+            self.assertEqual(error_rows[0], 'row,error')
+            self.assertEqual(
+                [r.split(',', 1)[0] for r in error_rows[1:]],
+                ['2', '3', '5', '6']
+            )
+
+            # The valid rows of each chunk were committed
+            imported_lines = self.SaleLine.search([
+                ('origin', '=', 'sale.line,%s' % sale_line.id),
+                ('sale', '!=', return_sale.id),
+            ], order=[('id', 'ASC')])
+            self.assertEqual(
+                [l.quantity for l in imported_lines], [-2, -1]
+            )
+            self.assertEqual(
+                imported_lines[0].return_reason, self.reason_1
+            )
+
+            csv_file = StringIO(
+                'origin,reason,return_type,quantity\n'
+                '%s,Reason \xff,credit,1\n'
+                '%s,Reason\x001,credit,1\n' % (sale_line.id, sale_line.id)
+            )
+            result = ReturnImport.import_file(csv_file)
+            self.assertEqual(result['rows'], 2)
+            self.assertEqual(result['errors'], 2)
+            self.assertEqual(result['sales'], 0)
+
+    def test_0260_test_return_event_cron(self):
+        """
+        Test the cron commits each delivered batch of committed events
+        """
+        ReturnEvent = POOL.get('sale.return.event')
+
+        self.addCleanup(self._delete_customers, ['Edward Nygma'])
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            self.assertEqual(ReturnEvent.cron_dispatch(), 0)
+
+            sale = self._create_sale(**self._create_customer('Edward Nygma'))
+            events = ReturnEvent.create([{
+                'sale': sale.id,
+                'type': 'confirmed',
+                'payload': json.dumps({'sale': sale.id, 'number': i}),
+            } for i in range(3)])
+            Transaction().cursor.commit()
+
+            fileobj = tempfile.NamedTemporaryFile(suffix='.jsonl')
+            self._set_event_target('file://' + fileobj.name)
+            try:
+                self.assertEqual(ReturnEvent.cron_dispatch(batch_size=2), 3)
+                self.assertEqual(ReturnEvent.cron_dispatch(), 0)
+            finally:
+                self._set_event_target(None)
+
+            delivered = map(json.loads, open(fileobj.name))
+            self.assertEqual([e['number'] for e in delivered], [0, 1, 2])
+            self.assertEqual([e['id'] for e in delivered], map(int, events))
+            self.assertEqual(
+                set(e.state for e in ReturnEvent.browse(map(int, events))),
+                set(['done'])
+            )
+
 
 def suite():
     "Define suite"